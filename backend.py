@@ -0,0 +1,245 @@
+"""
+Storage backends used by the db module
+
+A backend stores the data collected through the db.save event and
+hands it back, batch of products by batch of products, when loading:
+
+    exists()            whether there's anything to load
+    loaders()           fork the processes load() may use, before any
+                        thread is started; None if it uses none
+    load(callback, loaders)
+                        call callback(data) for every batch of products,
+                        data being the db.load event data, and return
+                        the remaining (meta) data
+    save(data)          store the collected data
+    verify()            check the stored data, return statistics
+    close()             release the resources
+
+Backends with `incremental` set receive only the products modified
+since the previous save, unless `needsFull()` says otherwise.
+Backends with `forkable` set can be saved from a forked child.
+"""
+
+import os
+import time
+import sqlite3
+import cPickle
+
+from exception import SnapshotException
+
+import snapshot
+
+class Backend(object):
+
+    incremental = False
+    forkable = False
+
+    def __init__(self, config):
+        self.config = config
+
+    def exists(self):
+        return os.path.exists(self.config['file_name'])
+
+    def needsFull(self):
+        return True
+
+    def loaders(self):
+        return None
+
+    def load(self, callback, loaders = None):
+        raise NotImplementedError()
+
+    def save(self, data):
+        raise NotImplementedError()
+
+    def verify(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+"""
+The whole data set in a single file, either pickled or in the
+chunked snapshot format (see snapshot.py)
+"""
+
+class FileBackend(Backend):
+
+    forkable = True
+
+    """
+    chunked databases are decoded by a pool of processes
+    """
+    def loaders(self):
+        if not self.exists():
+            return None
+        f = open(self.config['file_name'], 'rb')
+        try:
+            if not snapshot.isSnapshot(f):
+                return None
+        finally:
+            f.close()
+        return snapshot.pool(self.config['load_workers'])
+
+    def load(self, callback, loaders = None):
+        f = open(self.config['file_name'], 'rb')
+        try:
+            if snapshot.isSnapshot(f):
+                return snapshot.load(f, callback, loaders, self.config['load_workers'])
+            data = cPickle.load(f)
+            if 'products' in data:
+                callback({'products': data.pop('products')})
+            return data
+        finally:
+            f.close()
+
+    """
+    save data to a temporary file and move it over the database
+    so that a crash never leaves us with a truncated database
+    """
+    def save(self, data):
+        tmp = '%s.tmp.%d' % (self.config['file_name'], os.getpid())
+        f = open(tmp, 'wb')
+        if self.config['format'] == 'chunked':
+            snapshot.write(f, data)
+        else:
+            cPickle.dump(data, f, -1)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, self.config['file_name'])
+
+    def verify(self):
+        return snapshot.verify(self.config['file_name'])
+
+
+"""
+SQLite database in WAL mode; only the products modified since the
+last save are written, and the file can be queried by other
+processes while the server is running
+"""
+
+class SqliteBackend(Backend):
+
+    incremental = True
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS products (sku TEXT PRIMARY KEY, stock INTEGER NOT NULL, total_reservations INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS reservations (sku TEXT NOT NULL, client_id TEXT NOT NULL, qty INTEGER NOT NULL, timestamp REAL NOT NULL, ttl REAL, PRIMARY KEY (sku, client_id))',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)'
+    ]
+
+    # products handed over to the load callback at once
+    BATCH = 4096
+
+    def __init__(self, config):
+        super(SqliteBackend, self).__init__(config)
+        self.db = None
+        # whether the database holds everything we have in memory
+        self.complete = False
+
+    def connect(self):
+        if not self.db:
+            # saves are serialized by the db module, but they
+            # may come from different threads
+            self.db = sqlite3.connect(self.config['file_name'], check_same_thread = False)
+            self.db.text_factory = str
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for statement in SqliteBackend.SCHEMA:
+                self.db.execute(statement)
+            self.db.commit()
+        return self.db
+
+    def exists(self):
+        if not os.path.exists(self.config['file_name']):
+            return False
+        return self.connect().execute('SELECT COUNT(*) FROM meta').fetchone()[0] > 0
+
+    def needsFull(self):
+        # the first save after startup writes everything: the data
+        # may come from another backend and replayed journal records
+        # aren't tracked
+        return not self.complete
+
+    def load(self, callback, loaders = None):
+        db = self.connect()
+
+        products = {}
+        reservations = db.execute('SELECT sku, client_id, qty, timestamp, ttl FROM reservations ORDER BY sku')
+        pending = reservations.fetchone()
+        for (sku, stock, total) in db.execute('SELECT sku, stock, total_reservations FROM products ORDER BY sku'):
+            rdata = {}
+            # both cursors walk the skus in the same order
+            while pending and pending[0] <= sku:
+                if pending[0] == sku:
+                    rdata[pending[1]] = {'qty': pending[2], 'timestamp': pending[3], 'ttl': pending[4], 'deadline': None}
+                pending = reservations.fetchone()
+            products[sku] = {'stock': stock, 'totalReservations': total, 'reservations': rdata}
+            if len(products) >= SqliteBackend.BATCH:
+                callback({'products': products})
+                products = {}
+        if products:
+            callback({'products': products})
+
+        meta = {}
+        for (key, value) in db.execute('SELECT key, value FROM meta'):
+            meta[key] = cPickle.loads(str(value))
+
+        return meta
+
+    def save(self, data):
+        db = self.connect()
+        meta = dict(data)
+        products = meta.pop('products', {})
+        incremental = meta.pop('incremental', False)
+
+        started = time.time()
+        try:
+            if not incremental:
+                db.execute('DELETE FROM products')
+                db.execute('DELETE FROM reservations')
+            for sku in products:
+                pdata = products[sku]
+                db.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?)', (sku, pdata['stock'], pdata['totalReservations']))
+                if incremental:
+                    db.execute('DELETE FROM reservations WHERE sku = ?', (sku, ))
+                reservations = pdata['reservations']
+                db.executemany('INSERT INTO reservations VALUES (?, ?, ?, ?, ?)', [
+                    (sku, str(clid), reservations[clid]['qty'], reservations[clid]['timestamp'], reservations[clid].get('ttl'))
+                    for clid in reservations
+                ])
+            for key in meta:
+                db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, sqlite3.Binary(cPickle.dumps(meta[key], -1))))
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('saved', sqlite3.Binary(cPickle.dumps(started, -1))))
+            db.commit()
+        except:
+            db.rollback()
+            # the products collected for this save may not be collected
+            # by the next incremental one, make it a full one
+            self.complete = False
+            raise
+
+        self.complete = True
+
+    def verify(self):
+        db = self.connect()
+        result = db.execute('PRAGMA integrity_check').fetchone()[0]
+        if result != 'ok':
+            raise SnapshotException(result)
+        return {
+            'products': db.execute('SELECT COUNT(*) FROM products').fetchone()[0],
+            'reservations': db.execute('SELECT COUNT(*) FROM reservations').fetchone()[0]
+        }
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+
+BACKENDS = {
+    'file': FileBackend,
+    'sqlite': SqliteBackend
+}
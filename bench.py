@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+"""
+Load generator
+
+Starts a server on a free port with a temporary configuration (or
+uses a running one, see --connect), adds --products products and
+drives a mix of product commands over many connections for a while,
+then prints the throughput and the latencies as JSON:
+
+    python bench.py --connections 64 --depth 16 --skew 1.1 \\
+        --mix reservation.set=70,reservation.del=10,stock.get=15,product.info=5 \\
+        --server-option mode=inline --server-option reactors=2
+
+Connections are spread over --processes client processes so that
+the client doesn't become the bottleneck.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import bisect
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+from stats import Histogram
+from client import Connection, ConnectionError
+
+DEFAULT_MIX = 'reservation.set=70,reservation.del=10,stock.get=15,product.info=5'
+
+# commands the load can be made of
+COMMANDS = ('product.info', 'stock.get', 'reservation.add', 'reservation.del', 'reservation.set')
+
+# stock of the seeded products, big enough not to run out
+STOCK = 1000000000
+
+
+def freePort():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+"""
+start a server with a temporary configuration
+
+@return (process, port, temporary directory)
+"""
+def startServer(options):
+    path = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.mkdtemp(prefix = 'motherbee-bench-')
+    port = freePort()
+    general = {
+        'port': port,
+        'modules_path': os.path.join(path, 'modules'),
+        'modules': 'item_reservation',
+        'ipc_path': tmp
+    }
+    for o in options:
+        (k, v) = o.split('=', 1)
+        general[k.strip()] = v.strip()
+
+    conf = os.path.join(tmp, 'motherbee.conf')
+    f = open(conf, 'w')
+    f.write('[general]\n')
+    for k in general:
+        f.write('%s = %s\n' % (k, general[k]))
+    f.write('[logger]\nlog_level = error\nlog_file = %s\n' % os.path.join(tmp, 'motherbee.log'))
+    f.write('[expiration]\nttl = 300\n')
+    f.close()
+
+    out = open(os.path.join(tmp, 'motherbee.out'), 'w')
+    proc = subprocess.Popen([sys.executable, os.path.join(path, 'motherbee.py'), '-d', '-f', conf], stdout = out, stderr = out)
+
+    # wait for the server to accept connections
+    for i in xrange(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return (proc, port, tmp)
+        except socket.error:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    stopServer(proc, tmp)
+    raise RuntimeError('the server didn\'t start, see %s' % os.path.join(tmp, 'motherbee.out'))
+
+def stopServer(proc, tmp):
+    if proc.poll() is None:
+        proc.terminate()
+        proc.wait()
+    shutil.rmtree(tmp, True)
+
+
+"""
+pick sku indexes following a zipf distribution of exponent skew;
+a skew of 0 means uniform
+"""
+class SkuPicker:
+
+    def __init__(self, products, skew, rnd):
+        self.products = products
+        self.rnd = rnd
+        self.cumulative = None
+        if skew > 0:
+            total = 0.0
+            self.cumulative = []
+            for i in xrange(products):
+                total += 1.0 / ((i + 1) ** skew)
+                self.cumulative.append(total)
+
+    def pick(self):
+        if self.cumulative is None:
+            return self.rnd.randrange(self.products)
+        return min(bisect.bisect_left(self.cumulative, self.rnd.random() * self.cumulative[-1]), self.products - 1)
+
+
+def parseMix(mix):
+    ret = []
+    for item in mix.split(','):
+        (cmd, weight) = item.split('=')
+        cmd = cmd.strip()
+        if not cmd in COMMANDS:
+            raise ValueError('unknown command `%s\'' % cmd)
+        ret.append((cmd, float(weight)))
+    return ret
+
+def sku(i):
+    return 'sku%d' % i
+
+
+def seed(args):
+    conn = Connection(args.host, args.port, args.protocol)
+    batch = 1000
+    for start in xrange(0, args.products, batch):
+        count = min(batch, args.products - start)
+        conn.execute(''.join([conn.encode('product.add', [sku(i), STOCK]) for i in xrange(start, start + count)]), count)
+    conn.close()
+
+
+"""
+drive one connection until the deadline; every batch of --depth
+commands is sent at once and the latency of a command goes from
+the moment its batch was sent to the moment its response came in
+"""
+def drive(args, index, deadline, result):
+    rnd = random.Random(index)
+    picker = SkuPicker(args.products, args.skew, rnd)
+    mix = parseMix(args.mix)
+    total = sum([w for (c, w) in mix])
+    cumulative = []
+    acc = 0.0
+    for (c, w) in mix:
+        acc += w
+        cumulative.append(acc / total)
+
+    latency = Histogram()
+    codes = {}
+    counts = {}
+    try:
+        conn = Connection(args.host, args.port, args.protocol)
+        conn.connect()
+    except ConnectionError as e:
+        result.append({'error': str(e)})
+        return
+
+    client = 'bench%d' % index
+    try:
+        while time.time() < deadline:
+            cmds = []
+            for i in xrange(args.depth):
+                cmd = mix[min(bisect.bisect_left(cumulative, rnd.random()), len(mix) - 1)][0]
+                s = sku(picker.pick())
+                if cmd in ('stock.get', 'product.info'):
+                    cmds.append(conn.encode(cmd, [s]))
+                else:
+                    cmds.append(conn.encode(cmd, [client, s, 1]))
+                counts[cmd] = counts.get(cmd, 0) + 1
+            sent = time.time()
+            conn.send(''.join(cmds))
+            for i in xrange(args.depth):
+                (code, data) = conn.receive()
+                latency.record(time.time() - sent)
+                codes[code] = codes.get(code, 0) + 1
+    except (socket.error, ConnectionError) as e:
+        result.append({'error': str(e)})
+    conn.close()
+    result.append({'buckets': latency.buckets, 'max': latency.max, 'total': latency.total, 'codes': codes, 'counts': counts})
+
+
+"""
+client process: one thread per connection
+"""
+def client(args, indexes, deadline, queue):
+    result = []
+    threads = [threading.Thread(target = drive, args = (args, i, deadline, result)) for i in indexes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    queue.put(result)
+
+
+def run(args):
+    seed(args)
+
+    processes = max(1, min(args.processes or multiprocessing.cpu_count(), args.connections))
+    queue = multiprocessing.Queue()
+    started = time.time()
+    deadline = started + args.duration
+    clients = []
+    for p in xrange(processes):
+        indexes = range(p, args.connections, processes)
+        proc = multiprocessing.Process(target = client, args = (args, indexes, deadline, queue))
+        proc.start()
+        clients.append(proc)
+
+    results = []
+    for proc in clients:
+        results.extend(queue.get())
+    for proc in clients:
+        proc.join()
+    elapsed = time.time() - started
+
+    latency = Histogram()
+    codes = {}
+    counts = {}
+    errors = []
+    for r in results:
+        if 'error' in r:
+            errors.append(r['error'])
+            continue
+        for i in xrange(len(r['buckets'])):
+            latency.buckets[i] += r['buckets'][i]
+        latency.count += sum(r['buckets'])
+        latency.total += r['total']
+        latency.max = max(latency.max, r['max'])
+        for k in r['codes']:
+            codes[k] = codes.get(k, 0) + r['codes'][k]
+        for k in r['counts']:
+            counts[k] = counts.get(k, 0) + r['counts'][k]
+
+    return {
+        'config': {
+            'products': args.products,
+            'connections': args.connections,
+            'processes': processes,
+            'depth': args.depth,
+            'duration': args.duration,
+            'skew': args.skew,
+            'mix': args.mix,
+            'protocol': args.protocol,
+            'server_options': args.server_option
+        },
+        'elapsed': elapsed,
+        'requests': latency.count,
+        'throughput': latency.count / elapsed if elapsed else 0,
+        # microseconds
+        'latency': latency.summary(),
+        'commands': counts,
+        'codes': dict([(str(k), codes[k]) for k in codes]),
+        'errors': errors
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog = 'bench', description = 'MotherBee load generator')
+    parser.add_argument('--connect', help = 'host:port of a running server instead of starting one')
+    parser.add_argument('--server-option', action = 'append', default = [], metavar = 'KEY=VALUE',
+        help = 'general option of the started server, e.g. mode=inline (repeatable)')
+    parser.add_argument('--products', type = int, default = 10000, help = 'products to add first (default 10000)')
+    parser.add_argument('--connections', type = int, default = 32, help = 'concurrent connections (default 32)')
+    parser.add_argument('--processes', type = int, default = 0, help = 'client processes (default one per CPU)')
+    parser.add_argument('--depth', type = int, default = 1, help = 'commands pipelined per connection (default 1)')
+    parser.add_argument('--duration', type = float, default = 10, help = 'seconds to run (default 10)')
+    parser.add_argument('--skew', type = float, default = 0, help = 'zipf exponent of the sku popularity, 0 for uniform (default 0)')
+    parser.add_argument('--mix', default = DEFAULT_MIX, help = 'command weights (default %s)' % DEFAULT_MIX)
+    parser.add_argument('--protocol', choices = ['text', 'binary'], default = 'text')
+    parser.add_argument('--output', help = 'file to write the JSON report to (default stdout)')
+
+    args = parser.parse_args()
+    try:
+        parseMix(args.mix)
+    except ValueError as e:
+        parser.error('invalid --mix: %s' % e)
+
+    server = None
+    if args.connect:
+        (args.host, port) = args.connect.rsplit(':', 1)
+        args.port = int(port)
+    else:
+        (proc, port, tmp) = startServer(args.server_option)
+        server = (proc, tmp)
+        args.host = '127.0.0.1'
+        args.port = port
+
+    try:
+        report = run(args)
+    finally:
+        if server:
+            stopServer(*server)
+
+    out = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(out + '\n')
+        f.close()
+    else:
+        print out
+
+    sys.exit(1 if report['errors'] else 0)
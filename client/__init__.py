@@ -0,0 +1,30 @@
+"""
+MotherBee client
+
+    from client import Client
+
+    mb = Client('localhost', 2000)
+    mb.product_add('sku1', 10)
+    mb.reservation_set('client1', 'sku1', 2)
+    print mb.stock_get('sku1')
+
+    # many commands, one write, one round trip
+    with mb.pipeline() as p:
+        p.stock_get('sku1')
+        p.product_info('sku1')
+    print p.results
+
+    # changes pushed by the server instead of polling
+    s = Subscriber('localhost', 2000)
+    s.watch('sku1')
+    print s.listen()
+
+Clients are thread safe: every call borrows a connection from a
+pool and gives it back.
+"""
+
+from .exception import MotherBeeError, BusyError, TimeoutError, ResyncError, OwnerError, ConnectionError
+from .connection import Connection
+from .pool import Pool
+from .client import Client, Pipeline
+from .subscriber import Subscriber
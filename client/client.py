@@ -0,0 +1,199 @@
+"""
+High level client: one method per command, results returned as
+python values and errors raised as MotherBeeError
+"""
+
+from .pool import Pool
+from .exception import ConnectionError, error
+
+# commands giving the same result when run twice, retried once on a
+# new connection if the connection broke; the others (reservation.add
+# or stock.dec for instance) may have been run before the connection
+# broke, so the error is raised instead
+IDEMPOTENT = set([
+    'product.add',
+    'product.info',
+    'product.total',
+    'stock.set',
+    'stock.get',
+    'stock.load',
+    'changes.since',
+    'reservation.set',
+    'reservation.ttl',
+    'core.workers',
+    'core.opcodes',
+    'core.commands',
+    'core.load',
+    'core.stats',
+    'db.status'
+])
+
+"""
+typed helpers shared by Client and Pipeline; call() runs or queues
+a command
+"""
+class Commands:
+
+    def product_add(self, sku, stock):
+        return self.call('product.add', sku, int(stock))
+
+    def product_info(self, sku):
+        return self.call('product.info', sku)
+
+    def product_total(self):
+        return self.call('product.total')
+
+    def stock_set(self, sku, stock):
+        return self.call('stock.set', sku, int(stock))
+
+    def stock_dec(self, sku, count):
+        return self.call('stock.dec', sku, int(count))
+
+    def stock_get(self, sku):
+        return self.call('stock.get', sku)
+
+    """
+    add or update many products at once
+
+    @param items list of (sku, stock) or dict; skus can't hold commas
+    @return counts of added, updated and unchanged products
+    """
+    def stock_load(self, items):
+        if isinstance(items, dict):
+            items = items.items()
+        return self.call('stock.load', ','.join(['%s:%d' % (sku, int(stock)) for (sku, stock) in items]))
+
+    def reservation_add(self, client, sku, count):
+        return self.call('reservation.add', client, sku, int(count))
+
+    def reservation_del(self, client, sku, count):
+        return self.call('reservation.del', client, sku, int(count))
+
+    def reservation_set(self, client, sku, count):
+        return self.call('reservation.set', client, sku, int(count))
+
+    """
+    @param ttl Seconds, 0 for the server's default ttl
+    """
+    def reservation_ttl(self, client, sku, ttl):
+        return self.call('reservation.ttl', client, sku, int(ttl))
+
+    """
+    changes after a sequence of an epoch, raising ResyncError if
+    they're gone or the epoch isn't the current one (start from
+    epoch 0)
+
+    @return {'epoch' and 'seq': where to ask from next time, 'changes':
+            list of [sequence, sku, stock, reservations], 'more':
+            whether to ask again right away}
+    """
+    def changes_since(self, epoch, seq):
+        return self.call('changes.since', int(epoch), int(seq))
+
+
+class Client(Commands):
+
+    """
+    @param protocol 'text' or 'binary'
+    @param timeout  Socket timeout in seconds, None to block
+    @param deadline Milliseconds a command may wait on the server
+                    before being dropped, None for the server default
+    """
+    def __init__(self, host = 'localhost', port = 2000, pool_size = 8, protocol = 'text', timeout = None, deadline = None):
+        self.pool = Pool(host, port, pool_size, protocol, timeout)
+        self.deadline = deadline
+
+    def close(self):
+        self.pool.close()
+
+    """
+    run a command
+
+    @return the data of the result
+    """
+    def call(self, cmd, *args):
+        (code, data) = self.execute([(cmd, args)])[0]
+        if code != 0:
+            raise error(code, data)
+        return data
+
+    """
+    run commands in one round trip
+
+    @param cmds list of (command, arguments)
+    @return list of (code, data)
+    """
+    def execute(self, cmds):
+        retry = all([c in IDEMPOTENT for (c, a) in cmds])
+        conn = self.pool.get()
+        try:
+            data = ''.join([conn.encode(c, a, self.deadline) for (c, a) in cmds])
+            try:
+                return conn.execute(data, len(cmds))
+            except ConnectionError:
+                # the server may have restarted since the connection
+                # was last used
+                if not retry:
+                    raise
+                return conn.execute(data, len(cmds))
+        finally:
+            self.pool.put(conn)
+
+    """
+    run an arbitrary command, e.g. client.command('db.save')
+    """
+    def command(self, cmd, *args):
+        return self.call(cmd, *args)
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+"""
+commands queued and sent at once by execute(), or when leaving a
+with block; the results are then in the results attribute, failed
+commands having a MotherBeeError instead of their data
+"""
+class Pipeline(Commands):
+
+    def __init__(self, client):
+        self.client = client
+        self.cmds = []
+        self.results = None
+
+    def call(self, cmd, *args):
+        self.cmds.append((cmd, args))
+        return self
+
+    def command(self, cmd, *args):
+        return self.call(cmd, *args)
+
+    """
+    @param raise_errors Raise the first MotherBeeError found in the
+                        results once they are all read
+    @return the results
+    """
+    def execute(self, raise_errors = False):
+        cmds = self.cmds
+        self.cmds = []
+        self.results = []
+        if not cmds:
+            return self.results
+        for (code, data) in self.client.execute(cmds):
+            self.results.append(data if code == 0 else error(code, data))
+        if raise_errors:
+            for r in self.results:
+                if isinstance(r, Exception):
+                    raise r
+        return self.results
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.execute()
+        return False
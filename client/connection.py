@@ -0,0 +1,175 @@
+"""
+A connection to the server, speaking either the text or the binary
+protocol (see framing.py); binary connections ask the server for the
+opcodes of its commands
+"""
+
+import time
+import errno
+import socket
+import collections
+
+from . import framing
+from .exception import ConnectionError, error
+
+# code of the notifications the server pushes (see Subscriber)
+PUSH = 1
+
+# code of the unknown commands
+NO_SUCH_COMMAND = 100
+
+class Connection:
+
+    def __init__(self, host, port, protocol = 'text', timeout = None):
+        self.host = host
+        self.port = port
+        self.binary = protocol == 'binary'
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+        # notifications received while reading responses
+        self.notifications = collections.deque()
+        # command -> opcode, given by the server on connection
+        self.opcodes = None
+
+    def connect(self):
+        if self.sock:
+            return
+        try:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = ''
+            self.notifications.clear()
+            if self.binary:
+                self.sock.sendall(framing.MAGIC + framing.request(framing.OPCODES, []))
+                (code, self.opcodes) = self.receive()
+                if code != 0:
+                    raise socket.error(errno.EPROTO, 'can\'t get the opcodes: %s' % self.opcodes)
+        except socket.error as e:
+            self.close()
+            raise ConnectionError('can\'t connect to %s:%d: %s' % (self.host, self.port, e))
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def connected(self):
+        return self.sock is not None
+
+    """
+    encode a command
+
+    @param timeout Milliseconds the command may wait on the server
+                   before being dropped, None for the server default
+    """
+    def encode(self, cmd, args, timeout = None):
+        if self.binary:
+            # the opcodes come with the connection
+            self.connect()
+            opcode = self.opcodes.get(cmd)
+            if opcode is None:
+                # what the server answers to unknown commands
+                raise error(NO_SUCH_COMMAND, 'no such command')
+            if timeout is not None:
+                opcode |= framing.DEADLINE
+                args = [timeout] + list(args)
+            return framing.request(opcode, args)
+        if timeout is not None:
+            return framing.line(['@%d' % timeout, cmd] + list(args))
+        return framing.line([cmd] + list(args))
+
+    """
+    send encoded commands and read as many responses
+
+    @return list of (code, data)
+    """
+    def execute(self, data, count):
+        self.send(data)
+        try:
+            return [self.receive() for i in xrange(count)]
+        except socket.error as e:
+            self.close()
+            raise ConnectionError('%s:%d: %s' % (self.host, self.port, e))
+
+    """
+    send encoded commands, their responses are read by receive()
+    """
+    def send(self, data):
+        self.connect()
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            self.close()
+            raise ConnectionError('%s:%d: %s' % (self.host, self.port, e))
+
+    """
+    wait for a notification pushed by the server
+
+    @param timeout Seconds to wait, None for the socket timeout
+    @return (code, data) or None if none came in time
+    """
+    def notification(self, timeout = None):
+        self.connect()
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while not self.notifications:
+                res = self.decode()
+                if res is not None:
+                    # responses are only expected by execute()
+                    if res[0] == PUSH:
+                        self.notifications.append(res)
+                    continue
+                if deadline is not None:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return None
+                    self.sock.settimeout(left)
+                try:
+                    data = self.sock.recv(65536)
+                except socket.timeout:
+                    return None
+                finally:
+                    self.sock.settimeout(self.timeout)
+                if not data:
+                    raise socket.error(errno.ECONNRESET, 'connection closed by the server')
+                self.buffer += data
+        except socket.error as e:
+            self.close()
+            raise ConnectionError('%s:%d: %s' % (self.host, self.port, e))
+        return self.notifications.popleft()
+
+    """
+    read the next response; notifications coming first are kept
+    """
+    def receive(self):
+        while True:
+            res = self.decode()
+            if res is not None:
+                if res[0] != PUSH:
+                    return res
+                self.notifications.append(res)
+                continue
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error(errno.ECONNRESET, 'connection closed by the server')
+            self.buffer += data
+
+    """
+    decode the next response in the buffer
+
+    @return (code, data) or None if it isn't complete
+    """
+    def decode(self):
+        if self.binary:
+            (res, self.buffer) = framing.response(self.buffer)
+            return res
+        pos = self.buffer.find('\r\n')
+        if pos < 0:
+            return None
+        line = self.buffer[:pos]
+        self.buffer = self.buffer[pos + 2:]
+        return framing.decodeLine(line)
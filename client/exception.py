@@ -0,0 +1,59 @@
+"""
+Errors raised by the client
+"""
+
+class MotherBeeError(Exception):
+
+    def __init__(self, code, data):
+        super(MotherBeeError, self).__init__('%s (code %d)' % (data, code))
+        self.code = code
+        self.data = data
+
+"""
+The server is overloaded and refused the command without running it
+"""
+
+class BusyError(MotherBeeError):
+    pass
+
+"""
+The command waited longer than its deadline and wasn't run
+"""
+
+class TimeoutError(MotherBeeError):
+    pass
+
+"""
+The changes asked for are gone (changes.since); everything has to be
+read again, then the changes followed from data['epoch'] and
+data['seq']
+"""
+
+class ResyncError(MotherBeeError):
+    pass
+
+"""
+The product is owned by another server process than the one the
+connection landed on (watch, with several processes)
+"""
+
+class OwnerError(MotherBeeError):
+    pass
+
+"""
+The server can't be reached or closed the connection
+"""
+
+class ConnectionError(Exception):
+    pass
+
+
+ERRORS = {
+    301: OwnerError,
+    400: BusyError,
+    401: TimeoutError,
+    410: ResyncError
+}
+
+def error(code, data):
+    return ERRORS.get(code, MotherBeeError)(code, data)
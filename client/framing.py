@@ -0,0 +1,123 @@
+"""
+Wire framing shared by the server (see protocol.py) and the client;
+this module only depends on the standard library so that the client
+can be used without the server
+
+text    a command is its arguments separated by spaces, ended by \\n;
+        a response is a JSON object ended by \\r\\n
+
+binary  the client starts with the MAGIC byte, then sends frames:
+
+            length      uint32, size of the rest of the frame
+            opcode      uint16, with the DEADLINE bit set the first
+                        argument is the timeout in milliseconds
+            argc        uint8
+            argc times:
+                'i'     int64
+                's'     uint16 length followed by the bytes
+
+        and gets back frames with the same length prefix:
+
+            length      uint32
+            code        int16, result code
+            type        'n' (no data), 'i' (int64), 's' (bytes up to
+                        the end of the frame) or 'j' (JSON up to the
+                        end of the frame)
+            data
+
+All the integers are in network byte order.
+"""
+
+import json
+import struct
+
+# first byte sent by binary clients
+MAGIC = '\xbe'
+
+# opcode flag: the first argument is a timeout
+DEADLINE = 0x8000
+
+# opcode of core.opcodes, which clients ask for the others
+OPCODES = 4
+
+REQUEST = struct.Struct('!IHB')
+RESPONSE = struct.Struct('!IhB')
+LENGTH = struct.Struct('!I')
+INT = struct.Struct('!q')
+STR = struct.Struct('!H')
+
+# argument and data types
+TYPE_NONE = ord('n')
+TYPE_INT = ord('i')
+TYPE_STR = ord('s')
+TYPE_JSON = ord('j')
+
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+# largest frame accepted
+MAX_FRAME = 1048576
+
+
+"""
+build a text command line
+"""
+def line(args):
+    return ' '.join([str(a) for a in args]) + '\n'
+
+"""
+decode a text response line (without the \\r\\n)
+
+@return (code, data)
+"""
+def decodeLine(line):
+    res = json.loads(line)
+    data = res['data']
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return (res['code'], data)
+
+
+"""
+build a request frame; arguments are sent as int64 if they are
+integers and as bytes otherwise
+
+@raise struct.error if a string argument is longer than 64KB
+"""
+def request(opcode, args):
+    parts = []
+    for a in args:
+        if type(a) in (int, long):
+            parts.append(chr(TYPE_INT) + INT.pack(a))
+        else:
+            a = str(a)
+            parts.append(chr(TYPE_STR) + STR.pack(len(a)) + a)
+    body = ''.join(parts)
+    return REQUEST.pack(len(body) + 3, opcode, len(args)) + body
+
+"""
+decode the first response frame in the buffer
+
+@return ((code, data) or None if the frame isn't complete,
+         the remaining data)
+@raise ValueError on an unknown data type
+"""
+def response(buf):
+    if len(buf) < RESPONSE.size:
+        return (None, buf)
+    (length, code, t) = RESPONSE.unpack_from(buf)
+    end = 4 + length
+    if len(buf) < end:
+        return (None, buf)
+    start = RESPONSE.size
+    if t == TYPE_NONE:
+        data = None
+    elif t == TYPE_INT:
+        (data, ) = INT.unpack_from(buf, start)
+    elif t == TYPE_STR:
+        data = buf[start:end]
+    elif t == TYPE_JSON:
+        data = json.loads(buf[start:end])
+    else:
+        raise ValueError('invalid data type %d' % t)
+    return ((code, data), buf[end:])
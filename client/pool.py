@@ -0,0 +1,61 @@
+"""
+Thread safe pool of connections
+"""
+
+import Queue
+import threading
+
+from .connection import Connection
+from .exception import ConnectionError
+
+class Pool:
+
+    def __init__(self, host, port, size = 8, protocol = 'text', timeout = None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.protocol = protocol
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue()
+        # connections created so far
+        self.created = 0
+        self.lock = threading.Lock()
+
+    """
+    borrow a connection, waiting for one to be given back if all
+    of them are in use
+
+    @raise ConnectionError if none was given back within the timeout
+    """
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        self.lock.acquire()
+        create = self.created < self.size
+        if create:
+            self.created += 1
+        self.lock.release()
+
+        if create:
+            return Connection(self.host, self.port, self.protocol, self.timeout)
+        try:
+            return self.idle.get(True, self.timeout)
+        except Queue.Empty:
+            raise ConnectionError('no connection to %s:%d was given back in %ss' % (self.host, self.port, self.timeout))
+
+    """
+    give a connection back; broken connections are given back too,
+    they reconnect the next time they're used
+    """
+    def put(self, conn):
+        self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
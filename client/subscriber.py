@@ -0,0 +1,77 @@
+"""
+Push subscriptions: a connection of its own watching products, the
+server pushing the availability of the watched products whenever it
+changes instead of them being polled
+
+    from client import Subscriber
+
+    s = Subscriber('localhost', 2000)
+    states = s.watch('sku1', 'sku2')
+    while True:
+        changes = s.listen(5)
+        if changes:
+            states.update(changes)
+
+The server coalesces the changes of a product within its watch
+interval, a notification holds the latest state of every product that
+changed. States carry the version of the product, see product.info.
+A subscriber not reading its notifications fast enough is disconnected
+by the server (ConnectionError); the products then have to be watched
+again. With several server processes, a connection can only watch the
+products of the process it landed on (OwnerError for the others).
+"""
+
+from .connection import Connection
+from .exception import error
+
+class Subscriber:
+
+    """
+    @param protocol 'text' or 'binary'
+    @param timeout  Socket timeout in seconds, None to block
+    """
+    def __init__(self, host = 'localhost', port = 2000, protocol = 'text', timeout = None):
+        self.conn = Connection(host, port, protocol, timeout)
+
+    def close(self):
+        self.conn.close()
+
+    """
+    run commands in one round trip, raising the first error once
+    all the responses are read
+
+    @return list of the data of the results
+    """
+    def execute(self, cmd, args):
+        data = ''.join([self.conn.encode(cmd, [a]) for a in args])
+        results = self.conn.execute(data, len(args))
+        for (code, data) in results:
+            if code != 0:
+                raise error(code, data)
+        return [data for (code, data) in results]
+
+    """
+    watch products
+
+    @return sku -> current state of the product ('stock',
+            'reservations', 'available' and 'version')
+    """
+    def watch(self, *skus):
+        ret = {}
+        for data in self.execute('watch', skus):
+            ret.update(data)
+        return ret
+
+    def unwatch(self, *skus):
+        self.execute('unwatch', skus)
+
+    """
+    wait for the next notification
+
+    @param timeout Seconds to wait, None for the socket timeout
+    @return sku -> state of the products that changed, None if
+            nothing changed in time
+    """
+    def listen(self, timeout = None):
+        res = self.conn.notification(timeout)
+        return res[1] if res else None
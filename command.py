@@ -1,5 +1,7 @@
-import json
+import time
+
 from logger import Logger
+from stats import Histogram
 
 class Command:
 
@@ -8,17 +10,56 @@ class Command:
 
     commands = {}
 
+    # binary protocol opcode -> command
+    opcodes = {}
+
+    # when set, called with the command info, the arguments and the
+    # deadline before running a command; returns the response if it
+    # took care of the command (see shard.py)
+    router = None
+
     returnCodes = {
         0: 'success',
+        1: 'notification',
         100: 'no such command',
         200: 'invalid number of arguments',
-        300: 'error'
+        201: 'invalid argument',
+        300: 'error',
+        301: 'product owned by another process',
+        400: 'busy',
+        401: 'timeout',
+        410: 'resync required'
     }
 
     RET_SUCCESS = 0
+    # pushed by the server, answering no command (see Server.push)
+    RET_PUSH = 1
     RET_ERR_CMD = 100
     RET_ERR_ARGS = 200
+    RET_ERR_TYPE = 201
     RET_ERR_GENERAL = 300
+    # the command can only run on the process owning the product, not
+    # the one the connection landed on (see shard.py)
+    RET_ERR_OWNER = 301
+    RET_BUSY = 400
+    RET_TIMEOUT = 401
+    # the data asked for is gone, the client has to read everything again
+    RET_RESYNC = 410
+
+    # command classes, each one run by its own workers (see Manager):
+    # product commands, control commands which are to get through
+    # even under load, and slow commands
+    LANE_HOT = 'hot'
+    LANE_ADMIN = 'admin'
+    LANE_HEAVY = 'heavy'
+
+    # commands forwarded by another process (see shard.py), whatever
+    # their class; they never wait for another process, so a process
+    # forwarding a command never waits for a worker that is itself
+    # waiting for a command forwarded back
+    LANE_SHARD = 'shard'
+
+    LANES = [LANE_HOT, LANE_ADMIN, LANE_HEAVY, LANE_SHARD]
 
     """
     register a command
@@ -26,63 +67,233 @@ class Command:
     @param cmd Command
     @param nargs Number of arguments the command receives
     @param help Help string
+    @param blocking Whether the command may block (disk i/o, joining
+                    threads etc.); when the server runs commands inline
+                    these are still handed over to a worker thread
+    @param key Position of the sku among the arguments; when sharding,
+               the command is run by the process owning the sku
+    @param fanout Aggregator; when sharding, the command is run by all
+                  the processes and the aggregator merges the results
+    @param opcode Number identifying the command in the binary protocol
+    @param schema List of (name, type) pairs, one per argument; the
+                  type is called to convert the argument (str, int,
+                  float or any callable raising ValueError) so that
+                  handlers receive them already converted
+    @param lane Command class, one of the LANE_* values; defaults to
+                LANE_HEAVY for blocking commands and LANE_HOT otherwise
+    @param session Whether the handler also receives the connection
+                   the command came from, for commands keeping state
+                   about the connection (see the watch command)
     """
     @staticmethod
-    def register(handler, cmd, args, help = None):
+    def register(handler, cmd, args, help = None, blocking = False, key = None, fanout = None, opcode = None, schema = None, lane = None, session = False):
         if cmd in Command.commands:
             return False
+        if not callable(handler):
+            Logger.error('handler of `%s\' is not callable' % cmd)
+            return False
+        if schema is not None and len(schema) != args:
+            Logger.error('schema of `%s\' doesn\'t match its %d arguments' % (cmd, args))
+            return False
+        if lane is None:
+            lane = Command.LANE_HEAVY if blocking else Command.LANE_HOT
+        elif not lane in Command.LANES:
+            Logger.error('unknown lane `%s\' of `%s\'' % (lane, cmd))
+            return False
+        if help is None and schema:
+            help = ' '.join([cmd] + [name for (name, t) in schema])
+        if opcode is not None:
+            if opcode in Command.opcodes:
+                Logger.error('opcode %d of `%s\' is already used by `%s\'' % (opcode, cmd, Command.opcodes[opcode]))
+                opcode = None
+            else:
+                Command.opcodes[opcode] = cmd
         Command.commands[cmd] = {
             'args': args, 
             'help': help, 
-            'handler': handler
+            'handler': handler,
+            'blocking': blocking,
+            'key': key,
+            'fanout': fanout,
+            'opcode': opcode,
+            'schema': schema,
+            'lane': lane,
+            'session': session,
+            # the command name included
+            'argc': args + 1,
+            'convert': Command.compile(schema),
+            # counters; updated without locking, hence approximate
+            # when the same command runs on several threads at once
+            'calls': 0,
+            'errors': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'latency': Histogram()
         }
         return True
 
-    """ 
-    process a command and return a string
-    as a result
     """
-    @staticmethod 
-    def processCmd(args):
-        cmd = args[0]
-        if cmd not in Command.commands:
-            return Command.result(Command.RET_ERR_CMD)
+    build the function converting the arguments of a command
+    according to its schema; the name of the command is kept
+    """
+    @staticmethod
+    def compile(schema):
+        if not schema:
+            return None
+        converters = [str] + [t for (name, t) in schema]
+        return lambda args: [c(a) for (c, a) in zip(converters, args)]
 
-        if 'handler' in Command.commands[cmd]:
-            f = Command.commands[cmd]['handler']
+    """
+    whether a command was registered as blocking
+    """
+    @staticmethod
+    def isBlocking(cmd):
+        return cmd in Command.commands and Command.commands[cmd]['blocking']
 
-        if not f or not callable(f):
-            return Command.result(Command.RET_ERR_CMD)
+    """
+    look the command up and convert its arguments; this runs on
+    the network thread so that malformed commands never reach the
+    workers
+
+    @param deadline Time after which the command is not to be run
+                    anymore (see Command.run)
+    @return (command info, converted arguments, deadline) or, if the
+            command is to be rejected, (None, error result, None)
+    """
+    @staticmethod
+    def parse(args, deadline = None):
+        cmdInfo = Command.commands.get(args[0])
+        if cmdInfo is None:
+            return (None, Command.result(Command.RET_ERR_CMD), None)
 
         # check the number of parameters
-        cmdInfo = Command.commands[cmd]
-        if len(args[1:]) != cmdInfo['args']:
-            Logger.error(cmd + " needs " + str(cmdInfo['args']) + " arguments. Only " + str(len(args[1:])) + " were given. Received command was `" + str(args) + "`")
-            return Command.result(Command.RET_ERR_ARGS, cmdInfo['help'])
+        if len(args) != cmdInfo['argc']:
+            cmdInfo['rejected'] += 1
+            Logger.error(args[0] + " needs " + str(cmdInfo['args']) + " arguments. Only " + str(len(args) - 1) + " were given. Received command was `" + str(args) + "`")
+            return (None, Command.result(Command.RET_ERR_ARGS, cmdInfo['help']), None)
+
+        convert = cmdInfo['convert']
+        if convert:
+            try:
+                args = convert(args)
+            except (ValueError, TypeError):
+                cmdInfo['rejected'] += 1
+                return (None, Command.result(Command.RET_ERR_TYPE, cmdInfo['help']), None)
+
+        return (cmdInfo, args, deadline)
+
+    """
+    run a parsed command and return its result; commands whose
+    deadline passed while they were waiting for a worker are
+    answered with the timeout code instead
+
+    @param forwarded Whether the command was forwarded by another
+                     process, in which case it is always run locally
+    @param conn Connection the command came from
+    """
+    @staticmethod
+    def run(parsed, forwarded = False, conn = None):
+        (cmdInfo, args, deadline) = parsed
+        if cmdInfo is None:
+            return args
+
+        if deadline is not None and time.time() > deadline:
+            cmdInfo['timeouts'] += 1
+            return Command.result(Command.RET_TIMEOUT)
+
+        cmdInfo['calls'] += 1
+        started = time.time()
         try: 
-            return f(args[1:])
+            res = None
+            if Command.router and not forwarded:
+                res = Command.router(cmdInfo, args, deadline)
+            if res is None:
+                if cmdInfo['session']:
+                    res = cmdInfo['handler'](args[1:], conn)
+                else:
+                    res = cmdInfo['handler'](args[1:])
         except Exception as e:
             Logger.critical(str(e))
-            return Command.result(Command.RET_ERR_GENERAL, str(e))
+            res = Command.result(Command.RET_ERR_GENERAL, str(e))
+        cmdInfo['latency'].record(time.time() - started)
+
+        if res[0] != Command.RET_SUCCESS:
+            cmdInfo['errors'] += 1
+        return res
+
+    """ 
+    process a command and return its result
+    """
+    @staticmethod 
+    def processCmd(args, forwarded = False):
+        return Command.run(Command.parse(args), forwarded)
             
     """
-    packs the result and returns it
+    packs the result and returns it; the protocol of the
+    connection takes care of encoding it
+
+    @return (code, data)
     """
     @staticmethod
     def result(code = 0, msg = None):
 
-        if not Command.returnCodes[code]:
-            ret = {
-                'code': -1,
-                'data': 'internal error'
+        if not code in Command.returnCodes:
+            return (-1, 'internal error')
+
+        if msg is None:
+            return (code, Command.returnCodes[code])
+
+        return (code, msg)
+
+    """
+    list the commands with their binary protocol opcodes
+    """
+    @staticmethod
+    def opcodesCmd(args):
+        return Command.result(Command.RET_SUCCESS, dict([(Command.opcodes[o], o) for o in Command.opcodes]))
+
+    """
+    list the commands with their schemas and counters
+    """
+    @staticmethod
+    def commandsCmd(args):
+        ret = {}
+        for cmd in Command.commands:
+            cmdInfo = Command.commands[cmd]
+            ret[cmd] = {
+                'opcode': cmdInfo['opcode'],
+                'lane': cmdInfo['lane'],
+                'args': [name for (name, t) in cmdInfo['schema'] or []],
+                'calls': cmdInfo['calls'],
+                'errors': cmdInfo['errors'],
+                'rejected': cmdInfo['rejected'],
+                'timeouts': cmdInfo['timeouts']
             }
-        else:
-            ret = {'code': code}
-            if not msg:
-                ret['data'] = Command.returnCodes[code]
-            else:
-                ret['data'] = msg
+        return Command.result(Command.RET_SUCCESS, ret)
 
-        return json.dumps(ret)
-       
+    """
+    counters and latencies of the commands run so far
+    """
+    @staticmethod
+    def stats():
+        ret = {}
+        for cmd in Command.commands:
+            cmdInfo = Command.commands[cmd]
+            if not cmdInfo['calls'] and not cmdInfo['rejected']:
+                continue
+            ret[cmd] = {
+                'calls': cmdInfo['calls'],
+                'errors': cmdInfo['errors'],
+                'rejected': cmdInfo['rejected'],
+                'timeouts': cmdInfo['timeouts'],
+                'latency': cmdInfo['latency'].summary()
+            }
+        return ret
 
+    @staticmethod
+    def resetStats():
+        for cmd in Command.commands:
+            cmdInfo = Command.commands[cmd]
+            for k in ['calls', 'errors', 'rejected', 'timeouts']:
+                cmdInfo[k] = 0
+            cmdInfo['latency'].reset()
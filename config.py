@@ -26,7 +26,7 @@ class Config(object):
         Config.load()
 
         # register our "reloadCfg" command
-        Command.register(Config.reloadCmd, 'config.reload', 0, 'config.reload')
+        Command.register(Config.reloadCmd, 'config.reload', 0, 'config.reload', blocking = True, fanout = list, opcode = 3, lane = Command.LANE_ADMIN)
         
         # reload config when receiving SIGUSR1
         signal.signal(signal.SIGUSR1, Config.sigusr1)
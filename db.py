@@ -1,31 +1,55 @@
 """
-Implementation of database persistence using disk files
+Implementation of database persistence; the actual storage
+is done by one of the backends in backend.py
 """
 
 import os
 import sys
 import threading
-import cPickle
 import time
+import errno
+import multiprocessing
 
 from config import Config
 from logger import Logger
 from command import Command
 from event import Event
 from module import Module
+from journal import Journal
+from exception import SnapshotException
+from backend import BACKENDS
+from shard import Shard
+from stats import Stats
 
 class Db(threading.Thread):
 
     DEFAULTS = {
         'persistence': False,
         'file': '/var/lib/motherbee/motherbee.db',
-        'autosave_interval': 60
+        'backend': 'file',
+        'autosave_interval': 60,
+        'background_save': False,
+        'format': 'pickle',
+        'load_workers': 0,
+        'journal': False,
+        'journal_commit_interval': 10,
+        'journal_segment_size': 67108864,
+        'journal_max_segments': 8
     }
   
     def __init__(self):
 
         super(Db, self).__init__()
 
+        # processes decoding the database at startup, forked now
+        # since modules are imported before any of them starts a
+        # thread (see Backend.loaders)
+        self.config = {}
+        self.loadConfig()
+        self.loaders = None
+        if self.config['persistence']:
+            self.loaders = BACKENDS[self.config['backend']](self.config).loaders()
+
 
     """
     This is run by the modules manager
@@ -39,20 +63,42 @@ class Db(threading.Thread):
         
         self.running = False
 
+        # set while stopping; no background save is started anymore
+        self.stopping = False
+
         # initialize the event object used for sleeping
         self.event = threading.Event()
 
-        if self.config['persistence'] and os.path.exists(self.config['file_name']):
+        # mutations journal, if enabled
+        self.journal = None
+
+        # storage backend
+        self.backend = BACKENDS[self.config['backend']](self.config)
+
+        # serializes manual saves and autosaves
+        self.saveLock = threading.Lock()
+
+        # last background save job
+        self.job = None
+        self.jobId = 0
+
+        # set when no background save is running
+        self.jobDone = threading.Event()
+        self.jobDone.set()
+
+        if self.config['persistence']:
             try:
-                Logger.info('loading database from %s' % self.config['file_name'])
                 self.load()
             except Exception as e:
                 Logger.critical(str(e))
+        self.stopLoaders()
 
         self.setup()
 
         # register our 'save' commands
-        Command.register(self.saveCmd, 'db.save', 0, 'db.save')
+        Command.register(self.saveCmd, 'db.save', 0, 'db.save', blocking = True, fanout = list, opcode = 10)
+        Command.register(self.statusCmd, 'db.status', 0, 'db.status', fanout = list, opcode = 11, lane = Command.LANE_ADMIN)
+        Command.register(self.verifyCmd, 'db.verify', 0, 'db.verify', blocking = True, fanout = list, opcode = 12)
         
         # treat events
         Event.register('core.reload', self.reloadEvent)
@@ -61,7 +107,23 @@ class Db(threading.Thread):
     def loadConfig(self):
         self.config['persistence'] = Config.getboolean('database', 'persistence', Db.DEFAULTS['persistence']) 
         self.config['file_name'] = Config.get('database', 'file', Db.DEFAULTS['file'])
+        if Shard.enabled():
+            # every shard persists its own products
+            self.config['file_name'] += '.%d' % Shard.index
+        self.config['backend'] = Config.get('database', 'backend', Db.DEFAULTS['backend'])
+        if not self.config['backend'] in BACKENDS:
+            Logger.error('unknown database backend `%s\', falling back to `%s\'' % (self.config['backend'], Db.DEFAULTS['backend']))
+            self.config['backend'] = Db.DEFAULTS['backend']
         self.config['autosave_interval'] = Config.getint('database', 'autosave_interval', Db.DEFAULTS['autosave_interval'])
+        self.config['background_save'] = Config.getboolean('database', 'background_save', Db.DEFAULTS['background_save'])
+        self.config['format'] = Config.get('database', 'format', Db.DEFAULTS['format'])
+        self.config['load_workers'] = Config.getint('database', 'load_workers', Db.DEFAULTS['load_workers'])
+        if self.config['load_workers'] <= 0:
+            self.config['load_workers'] = multiprocessing.cpu_count()
+        self.config['journal'] = Config.getboolean('database', 'journal', Db.DEFAULTS['journal'])
+        self.config['journal_commit_interval'] = Config.getint('database', 'journal_commit_interval', Db.DEFAULTS['journal_commit_interval'])
+        self.config['journal_segment_size'] = Config.getint('database', 'journal_segment_size', Db.DEFAULTS['journal_segment_size'])
+        self.config['journal_max_segments'] = Config.getint('database', 'journal_max_segments', Db.DEFAULTS['journal_max_segments'])
   
         
     """
@@ -78,10 +140,7 @@ class Db(threading.Thread):
     stop the thread
     """
     def stop(self):
-        if self.config['persistence']:
-            # save when stopping
-            Logger.info('saving database to %s' % self.config['file_name'])
-            self.save()
+        self.stopping = True
         if self.running:
             Logger.info('stopping the database manager')
             self.running = False
@@ -90,19 +149,57 @@ class Db(threading.Thread):
             # so that the next wait would actually wait
             self.event.clear()
             self.join()
+        if self.config['persistence']:
+            # save when stopping, once the background save running if
+            # any is over; finishing after this one, it would overwrite
+            # it with older data
+            self.jobDone.wait()
+            Logger.info('saving database to %s' % self.config['file_name'])
+            self.save()
+        self.stopJournal()
+        self.backend.close()
 
 
     def setup(self):
         if self.config['persistence'] == True and len(self.config['file_name']) > 0:
+            # incremental backends need to know what changed between saves
+            Event.dispatch('db.track', self.backend.incremental)
+            if self.config['journal']:
+                self.startJournal()
             if self.config['autosave_interval'] > 0:
                 self.start()
 
+    def startJournal(self):
+        if self.journal:
+            return
+        self.journal = Journal(
+            self.config['file_name'],
+            self.config['journal_commit_interval'] / 1000.0,
+            self.config['journal_segment_size'],
+            self.config['journal_max_segments']
+        )
+        self.journal.open()
+        self.journal.start()
+        Event.register('db.journal', self.journalEvent)
+
+    def stopJournal(self):
+        if not self.journal:
+            return
+        Event.unregister('db.journal', self.journalEvent)
+        self.journal.stop()
+        self.journal = None
+
+    def journalEvent(self, record):
+        self.journal.append(record)
+
 
     def reloadEvent(self, *args):
         self.stop()
+        self.stopping = False
         # we need this to start the thread again
         super(Db, self).__init__()
         self.loadConfig()
+        self.backend = BACKENDS[self.config['backend']](self.config)
         self.setup()
 
 
@@ -115,9 +212,15 @@ class Db(threading.Thread):
     def run(self):
         while self.running:
             self.event.wait(self.config['autosave_interval'])
+            if not self.running:
+                # woken up by stop(), which saves by itself
+                break
             try:
-                Logger.info('saving database to %s' % self.config['file_name'])
-                self.save()
+                if self.config['background_save'] and self.backend.forkable:
+                    self.saveBackground()
+                else:
+                    Logger.info('saving database to %s' % self.config['file_name'])
+                    self.save()
             except Exception as e:
                 Logger.error("an error occured while trying to save the database to %s" % self.config['file_name'])
                 Logger.error(str(e))
@@ -129,19 +232,129 @@ class Db(threading.Thread):
     @return False on error
     """
     def save(self):
+        self.saveLock.acquire()
+        try:
+            self.saveUnlocked()
+        finally:
+            self.saveLock.release()
+
+    def saveUnlocked(self):
 
         data = {}
 
+        # everything journaled so far is about to be covered by the snapshot
+        if self.journal:
+            data['journal'] = self.journal.rotate()
+
+        # only collect what changed since the last save, if possible
+        if self.backend.incremental and not self.backend.needsFull():
+            data['incremental'] = True
+
+        started = time.time()
+
         # collect data from all modules
         Event.dispatch('db.save', data)
         
-        # save data to the database
-        f = open(self.config['file_name'], 'wb')
-        cPickle.dump(data, f, -1)
-        f.close()
+        self.backend.save(data)
+
+        Stats.set('db.last_save', {'finished': time.time(), 'duration': time.time() - started, 'background': False})
+
+        if 'journal' in data:
+            self.journal.truncate(data['journal'])
 
         del data
 
+    """
+    Save the product data from a forked child, the way redis' BGSAVE
+    does; the child works on a copy-on-write image of our memory so
+    the only pause we take is the fork itself
+
+    @return the job, or the already running one, or None if the
+            database was saved right away because we're stopping
+    """
+    def saveBackground(self):
+        self.saveLock.acquire()
+        try:
+            if self.stopping:
+                # a child could outlive us
+                self.saveUnlocked()
+                return None
+
+            if self.job and self.job['status'] == 'running':
+                return self.job
+
+            self.jobId += 1
+            job = {
+                'job': self.jobId,
+                'status': 'running',
+                'started': time.time(),
+                'finished': None,
+                'duration': None,
+                'fork': None
+            }
+
+            # rotate before forking: every record in the older
+            # segments is part of the child's memory image
+            seq = self.journal.rotate() if self.journal else None
+
+            pid = os.fork()
+            if pid == 0:
+                # no other threads exist in here, and the locks they
+                # held are never released, so stay away from locks,
+                # including the logger's
+                code = 1
+                try:
+                    data = {}
+                    if seq is not None:
+                        data['journal'] = seq
+                    Event.dispatch('db.snapshot', data)
+                    self.backend.save(data)
+                    code = 0
+                except:
+                    pass
+                os._exit(code)
+
+            job['fork'] = time.time() - job['started']
+            job['pid'] = pid
+            job['seq'] = seq
+            self.job = job
+            self.jobDone.clear()
+
+            waiter = threading.Thread(target = self.waitBackground, args = (job, ))
+            waiter.daemon = True
+            waiter.start()
+
+            Logger.info('background save %d started (pid %d, fork took %.3fs)' % (job['job'], pid, job['fork']))
+            return job
+        finally:
+            self.saveLock.release()
+
+    """
+    wait for the child of a background save to finish
+    """
+    def waitBackground(self, job):
+        while True:
+            try:
+                (pid, status) = os.waitpid(job['pid'], 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    status = -1
+                    break
+
+        job['finished'] = time.time()
+        job['duration'] = job['finished'] - job['started']
+        if status == 0:
+            Stats.set('db.last_save', {'finished': job['finished'], 'duration': job['duration'], 'background': True})
+            job['status'] = 'done'
+            if job['seq'] is not None and self.journal:
+                self.journal.truncate(job['seq'])
+            Logger.info('background save %d finished in %.3fs' % (job['job'], job['duration']))
+        else:
+            job['status'] = 'failed'
+            Logger.error('background save %d failed (status %d)' % (job['job'], status))
+        self.jobDone.set()
+
 
     """
     Load product data from the db
@@ -150,22 +363,73 @@ class Db(threading.Thread):
     @return False on error
     """
     def load(self):
-        f = open(self.config['file_name'], 'rb')
-        data = cPickle.load(f)
-        f.close()
-        Event.dispatch('db.load', data)
+        data = {}
+        if self.backend.exists():
+            Logger.info('loading database from %s' % self.config['file_name'])
+            started = time.time()
+            # products are handed over batch by batch
+            try:
+                data = self.backend.load(self.loadChunk, self.loaders)
+            finally:
+                self.stopLoaders()
+            Event.dispatch('db.load', data)
+            Logger.info('database loaded in %.3fs' % (time.time() - started))
+
+        # replay whatever happened after the snapshot was taken
+        journal = Journal(self.config['file_name'], 0, 0, 0)
+        count = journal.replay(data.get('journal', 0), self.replayRecord)
+        if count > 0:
+            Logger.info('replayed %d journal records' % count)
+
+        Event.dispatch('db.loaded', None)
         del data
+
+    def loadChunk(self, data):
+        Event.dispatch('db.load', data)
+
+    def stopLoaders(self):
+        if self.loaders:
+            self.loaders.terminate()
+            self.loaders.join()
+            self.loaders = None
+
+    def replayRecord(self, record):
+        Event.dispatch('db.replay', record)
     
     
     """
     'save' command
     """
     def saveCmd(self, *args):
-        if self.config['persistence']:
-            self.save()
-            return Command.result(Command.RET_SUCCESS)
-        else:
+        if not self.config['persistence']:
             return Command.result(Command.RET_ERR_GENERAL, 'database persistence is disabled')
+        if self.config['background_save'] and self.backend.forkable:
+            job = self.saveBackground()
+            if job is None:
+                return Command.result(Command.RET_SUCCESS)
+            return Command.result(Command.RET_SUCCESS, {'job': job['job']})
+        self.save()
+        return Command.result(Command.RET_SUCCESS)
+
+    """
+    'verify' command; checks the database file
+    """
+    def verifyCmd(self, *args):
+        try:
+            return Command.result(Command.RET_SUCCESS, self.backend.verify())
+        except (SnapshotException, IOError) as e:
+            return Command.result(Command.RET_ERR_GENERAL, str(e))
+
+    """
+    'status' command; reports on the last background save
+    """
+    def statusCmd(self, *args):
+        if not self.job:
+            return Command.result(Command.RET_ERR_GENERAL, 'no background save was started')
+        ret = {}
+        for k in ['job', 'status', 'started', 'finished', 'duration', 'fork']:
+            ret[k] = self.job[k]
+        return Command.result(Command.RET_SUCCESS, ret)
 
 
 Module.register('db', Db()) 
@@ -15,6 +15,14 @@ class Event:
             Event.observers[event] = []
         Event.observers[event].append(observer)
 
+    """
+    Unregister an observer
+    """
+    @staticmethod
+    def unregister(event, observer):
+        if event in Event.observers and observer in Event.observers[event]:
+            Event.observers[event].remove(observer)
+
     """
     Dispatch an event to all its observers
     """
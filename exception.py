@@ -7,3 +7,17 @@ internal errors and our own error messages
 
 class MotherBeeException(Exception):
     pass
+
+"""
+Raised when a database snapshot can't be read
+"""
+
+class SnapshotException(MotherBeeException):
+    pass
+
+"""
+Raised when a client sends something we can't decode
+"""
+
+class ProtocolException(MotherBeeException):
+    pass
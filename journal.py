@@ -0,0 +1,301 @@
+"""
+Append-only journal of data mutations
+
+Every mutation is appended as a self-contained record describing the
+resulting state of a single key (a product's stock or a client's
+reservation), so replaying a record more than once or on top of a
+snapshot that already contains it is harmless.
+
+Records are buffered in memory and written to the current segment by
+a background thread which fsyncs once per commit interval (group
+commit). Segments are named <db file>.journal.<seq>; a snapshot
+records the sequence of the segment that was opened right before it
+was taken, and all the older segments are deleted once the snapshot
+is safely on disk.
+"""
+
+import os
+import glob
+import time
+import zlib
+import struct
+import cPickle
+import threading
+
+from logger import Logger
+
+class Journal(threading.Thread):
+
+    # record header: payload length and crc32 of the payload
+    HEADER = struct.Struct('!Ii')
+
+    def __init__(self, fileName, commitInterval, segmentSize, maxSegments):
+
+        super(Journal, self).__init__()
+
+        self.daemon = True
+
+        self.prefix = fileName + '.journal.'
+
+        # seconds between two group commits
+        self.commitInterval = commitInterval
+
+        # segment size (bytes) triggering a rotation
+        self.segmentSize = segmentSize
+
+        # closed segments count triggering a compaction
+        self.maxSegments = maxSegments
+
+        # encoded records waiting for the next commit
+        self.buffer = []
+
+        # protects the buffer
+        self.bufferLock = threading.Lock()
+
+        # serializes writes, rotations, truncations and compactions
+        self.segmentsLock = threading.RLock()
+
+        # current segment
+        self.seq = 0
+        self.fd = None
+        self.size = 0
+
+        # whether segments were closed since the last compaction check
+        self.closed = False
+
+        self.running = False
+        self.event = threading.Event()
+
+
+    def segmentName(self, seq):
+        return '%s%08d' % (self.prefix, seq)
+
+    """
+    sequence numbers of the segments found on disk, sorted
+    """
+    def segments(self):
+        ret = []
+        for f in glob.glob(self.prefix + '*'):
+            try:
+                ret.append(int(f[len(self.prefix):]))
+            except ValueError:
+                pass
+        ret.sort()
+        return ret
+
+
+    """
+    iterate over the records of a segment; stops at the first torn
+    or corrupted record, which can only be the tail of the segment
+    the server was writing to when it went down
+    """
+    def records(self, seq):
+        f = open(self.segmentName(seq), 'rb')
+        try:
+            while True:
+                header = f.read(Journal.HEADER.size)
+                if len(header) < Journal.HEADER.size:
+                    if len(header) > 0:
+                        Logger.warn('truncated record at the end of %s' % self.segmentName(seq))
+                    break
+                (length, crc) = Journal.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    Logger.warn('corrupted record in %s, ignoring the rest of the segment' % self.segmentName(seq))
+                    break
+                yield cPickle.loads(payload)
+        finally:
+            f.close()
+
+
+    """
+    replay the segments starting with (and including) fromSeq
+
+    @return number of replayed records
+    """
+    def replay(self, fromSeq, callback):
+        count = 0
+        for seq in self.segments():
+            if seq < fromSeq:
+                continue
+            for record in self.records(seq):
+                callback(record)
+                count += 1
+        return count
+
+
+    def encode(self, record):
+        payload = cPickle.dumps(record, -1)
+        return Journal.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    """
+    queue a record for the next group commit
+    """
+    def append(self, record):
+        data = self.encode(record)
+        self.bufferLock.acquire()
+        self.buffer.append(data)
+        self.bufferLock.release()
+
+
+    """
+    open a new segment after the ones already on disk
+    """
+    def open(self):
+        segments = self.segments()
+        self.openSegment(segments[-1] + 1 if segments else 1)
+
+    def openSegment(self, seq):
+        self.seq = seq
+        self.fd = os.open(self.segmentName(seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        self.size = 0
+        self.closed = True
+
+    """
+    write the buffered records and fsync them; the buffer is taken
+    with the segments locked so that records taken by one commit can't
+    be written after the records of a later one (see rotate)
+    """
+    def commit(self):
+        self.segmentsLock.acquire()
+        try:
+            self.bufferLock.acquire()
+            buf = self.buffer
+            self.buffer = []
+            self.bufferLock.release()
+
+            if not buf:
+                return
+
+            data = ''.join(buf)
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            os.fsync(self.fd)
+            self.size += written
+            if self.size >= self.segmentSize:
+                self.rotateUnlocked()
+        finally:
+            self.segmentsLock.release()
+
+
+    def rotateUnlocked(self):
+        os.close(self.fd)
+        self.openSegment(self.seq + 1)
+
+    """
+    commit pending records and start a new segment; everything appended
+    before this call lands in segments older than the returned sequence
+
+    @return sequence of the new segment
+    """
+    def rotate(self):
+        self.segmentsLock.acquire()
+        try:
+            self.commit()
+            self.rotateUnlocked()
+            return self.seq
+        finally:
+            self.segmentsLock.release()
+
+
+    """
+    delete the segments older than seq; they are covered by a snapshot
+    """
+    def truncate(self, seq):
+        self.segmentsLock.acquire()
+        try:
+            for s in self.segments():
+                if s < seq:
+                    os.unlink(self.segmentName(s))
+        finally:
+            self.segmentsLock.release()
+
+
+    """
+    merge the closed segments into a single one holding only the
+    latest record for each key
+    """
+    def compact(self):
+        closed = [s for s in self.segments() if s < self.seq]
+        if len(closed) <= self.maxSegments:
+            return
+
+        started = time.time()
+        products = {}
+        reservations = {}
+        try:
+            for seq in closed:
+                for record in self.records(seq):
+                    if record[0] == 'product.add':
+                        if not record[1] in products:
+                            products[record[1]] = [record, None]
+                    elif record[0] == 'stock.set':
+                        products.setdefault(record[1], [None, None])[1] = record
+                    else:
+                        reservations[(record[1], record[2])] = record
+        except IOError:
+            # a snapshot truncated the journal in the meantime
+            return
+
+        # products go first so that reservations find their sku
+        last = closed[-1]
+        tmp = self.segmentName(last) + '.tmp'
+        f = open(tmp, 'wb')
+        for sku in products:
+            for record in products[sku]:
+                if record:
+                    f.write(self.encode(record))
+        for key in reservations:
+            f.write(self.encode(reservations[key]))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        self.segmentsLock.acquire()
+        try:
+            if not os.path.exists(self.segmentName(last)):
+                # a snapshot truncated the journal in the meantime
+                os.unlink(tmp)
+                return
+            os.rename(tmp, self.segmentName(last))
+            for seq in closed[:-1]:
+                if os.path.exists(self.segmentName(seq)):
+                    os.unlink(self.segmentName(seq))
+        finally:
+            self.segmentsLock.release()
+
+        Logger.info('compacted %d journal segments in %.3fs' % (len(closed), time.time() - started))
+
+
+    """
+    group commit thread
+    """
+    def run(self):
+        while self.running:
+            self.event.wait(self.commitInterval)
+            try:
+                self.commit()
+                if self.closed:
+                    # only worth looking once segments were closed
+                    self.closed = False
+                    self.compact()
+            except Exception as e:
+                Logger.error('an error occured while writing the journal: %s' % str(e))
+
+        self.commit()
+        os.close(self.fd)
+        self.fd = None
+
+    def start(self):
+        if not self.running:
+            Logger.info('starting the journal (segment %d)' % self.seq)
+            self.running = True
+            super(Journal, self).start()
+
+    def stop(self):
+        if self.running:
+            Logger.info('stopping the journal')
+            self.running = False
+            self.event.set()
+            self.join()
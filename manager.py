@@ -1,4 +1,5 @@
 import threading
+import time
 import worker
 import socket
 import errno
@@ -10,24 +11,55 @@ from command import Command
 from logger import Logger
 from config import Config
 from event import Event
+from shard import Shard
+from exception import ProtocolException
+from stats import Stats
 
-class Manager(threading.Thread):
+import protocol
 
-    # 1M buffer size
-    MAX_BUFFER_SIZE = 1048576
+class Manager(threading.Thread):
 
     # default configuration values
     DEFAULTS = {
         'workers': 500,
-        'scale_down_interval': 60
+        'admin_workers': 2,
+        'heavy_workers': 1,
+        'shard_workers': 8,
+        'scale_down_interval': 60,
+        'mode': 'threaded',
+        'read_size': 65536,
+        'worker_queue': 64,
+        'max_inflight': 100000,
+        'connection_bytes': 1048576,
+        'timeout': 0
+    }
+
+    # prefix of the timeout of a command
+    DEADLINE = '@'
+
+    # reasons for answering busy
+    SHED_QUEUE = 'worker_queue'
+    SHED_INFLIGHT = 'max_inflight'
+    SHED_CONNECTION = 'connection_bytes'
+
+    # option holding the number of workers of each lane
+    BUDGETS = {
+        Command.LANE_HOT: 'workers',
+        Command.LANE_ADMIN: 'admin_workers',
+        Command.LANE_HEAVY: 'heavy_workers',
+        Command.LANE_SHARD: 'shard_workers'
     }
 
+    # server modes
+    MODE_THREADED = 'threaded'
+    MODE_INLINE = 'inline'
+
     def __init__(self, server):
 
         super(Manager, self).__init__()
 
-        # list of workers
-        self.workers = []
+        # lists of workers, by lane
+        self.workers = dict([(lane, []) for lane in Command.LANES])
 
         # mutex for the list of workers
         self.workersLock = threading.RLock()
@@ -42,17 +74,30 @@ class Manager(threading.Thread):
         self.config = {}
         self.loadConfig()
 
-        # available idle threads
-        self.idleWorkers = Queue.Queue()
+        # available idle threads, by lane
+        self.idleWorkers = dict([(lane, Queue.Queue()) for lane in Command.LANES])
+
+        # round robin position among the workers, by lane
+        self.nextWorker = dict([(lane, 0) for lane in Command.LANES])
+
+        # commands handed over to the workers and not run yet
+        self.inflight = 0
+
+        # commands answered busy, by reason
+        self.shed = {Manager.SHED_QUEUE: 0, Manager.SHED_INFLIGHT: 0, Manager.SHED_CONNECTION: 0}
+
+        # protects the counters above
+        self.loadLock = threading.Lock()
 
         # read buffer to collect data from sockets
-        # and split it later by \n and feed it to workers
-        # when a \n is met
+        # and split it later into commands (see protocol.py)
+        # and feed them to workers
         # fd -> buffer
         self.readBuffer = {}
    
         # register commands
-        Command.register(self.workersCmd, 'core.workers', 0)
+        Command.register(self.workersCmd, 'core.workers', 0, fanout = list, opcode = 2, lane = Command.LANE_ADMIN)
+        Command.register(self.loadCmd, 'core.load', 0, 'core.load', fanout = list, opcode = 6, lane = Command.LANE_ADMIN)
 
         # register for the core.reload event
         Event.register('core.reload', self.reloadEvent)
@@ -62,45 +107,60 @@ class Manager(threading.Thread):
 
 
     def loadConfig(self):
-        self.config['workers'] = Config.getint('general', 'workers', Manager.DEFAULTS['workers'])
+        for k in Manager.BUDGETS.values():
+            self.config[k] = Config.getint('general', k, Manager.DEFAULTS[k])
         self.config['scale_down_interval'] = Config.getint('general', 'scale_down_interval', Manager.DEFAULTS['scale_down_interval'])
+        self.config['read_size'] = Config.getint('general', 'read_size', Manager.DEFAULTS['read_size'])
+        # limits, 0 meaning unlimited
+        for k in [Manager.SHED_QUEUE, Manager.SHED_INFLIGHT, Manager.SHED_CONNECTION]:
+            self.config[k] = Config.getint('general', k, Manager.DEFAULTS[k])
+        self.config['timeout'] = Config.getint('general', 'timeout', Manager.DEFAULTS['timeout'])
+        self.config['mode'] = Config.get('general', 'mode', Manager.DEFAULTS['mode'])
+        if not self.config['mode'] in [Manager.MODE_THREADED, Manager.MODE_INLINE]:
+            Logger.error('unknown server mode `%s\', falling back to `%s\'' % (self.config['mode'], Manager.DEFAULTS['mode']))
+            self.config['mode'] = Manager.DEFAULTS['mode']
        
 
     def reloadEvent(self):
         self.loadConfig()
 
     def idleWorkerPush(self, w):
-        self.idleWorkers.put(w)
+        self.idleWorkers[w.lane].put(w)
 
-    def idleWorkerPop(self):
+    def idleWorkerPop(self, lane):
         ret = None
-        if not self.idleWorkers.empty():
+        if not self.idleWorkers[lane].empty():
             try:
-                ret = self.idleWorkers.get_nowait()
+                ret = self.idleWorkers[lane].get_nowait()
             except:
                 Logger.exception()
 
         if ret:
-            self.idleWorkers.task_done()
+            ret.idle = False
+            self.idleWorkers[lane].task_done()
         return ret
 
     """
-    pick a worker, either from the idle workers queue or
-    by creating one or by computing the worker with the
-    smallest job queue
+    pick a worker of a lane for a connection, either from the idle
+    workers queue or by creating one or by going round the workers
+    for one whose queue isn't full; idle workers steal connections
+    from the busy ones anyway
+
+    @return the worker, None if all of them are full
     """
-    def pickWorkerUnlocked(self):
+    def pickWorkerUnlocked(self, lane):
 
         # try to pick an idle worker
-        ret = self.idleWorkerPop()
+        ret = self.idleWorkerPop(lane)
         if ret:
             return ret
 
         # try to start a new worker
-        if len(self.workers) < self.config['workers']:
+        workers = self.workers[lane]
+        if len(workers) < self.config[Manager.BUDGETS[lane]]:
             ret = None
             try:
-                ret = self.createWorker()
+                ret = self.createWorker(lane)
                 ret.start()
                 return ret
             except Exception as e:
@@ -110,95 +170,308 @@ class Manager(threading.Thread):
                     del ret
                     ret = None
 
-        # try to pick the least busy worker
-        _min = -1
-        for w in self.workers:
-            # compute the worker with the smallest
-            # queue and add the job to it
-            _size = w.getQSize()
-            if (_size < _min or _min == -1):
-                ret = w
-                _min = _size
-
-        return ret
+        count = len(workers)
+        for i in xrange(count):
+            self.nextWorker[lane] = (self.nextWorker[lane] + 1) % count
+            ret = workers[self.nextWorker[lane]]
+            if not ret.full():
+                return ret
+        return None
 
     """
     read bytes from the socket and try to split them
-    into commands which will be feeded to the workers
+    into commands which are validated (see Command.parse)
+    and either run right away or feeded to the workers,
+    depending on the mode
     """
     def dispatch(self, conn):
 
-        processed = False
+        (cmds, size, closed) = self.read(conn)
+
+        if not cmds:
+            return not closed
+
+        for job in self.split(conn, self.parse(conn, cmds), size):
+            if self.config['mode'] == Manager.MODE_INLINE:
+                self.runInline(job)
+            else:
+                self.assign(job)
+
+        return not closed
+
+    """
+    split parsed commands into jobs of consecutive commands of the
+    same lane; rejected commands go with the ones before them and
+    commands forwarded by another process all go to the shard lane
+    """
+    def split(self, conn, cmds, size):
+        jobs = []
+        for parsed in cmds:
+            if conn['forwarded']:
+                lane = Command.LANE_SHARD
+            elif parsed[0]:
+                lane = parsed[0]['lane']
+            else:
+                lane = jobs[-1]['lane'] if jobs else Command.LANE_HOT
+            if not jobs or jobs[-1]['lane'] != lane:
+                jobs.append({'conn': conn, 'commands': [], 'bytes': 0, 'lane': lane})
+            jobs[-1]['commands'].append(parsed)
+        # the bytes are accounted for as a whole
+        jobs[0]['bytes'] = size
+        return jobs
+
+    """
+    validate the commands (see Command.parse) and work out their
+    deadlines, counted from now: a command may be prefixed with
+    @<milliseconds> while @<milliseconds> alone sets the timeout of
+    the connection's next commands (@0 for none)
+    """
+    def parse(self, conn, cmds):
+        now = time.time()
+        ret = []
+        for c in cmds:
+            timeout = conn['timeout']
+            if c[0][:1] == Manager.DEADLINE:
+                try:
+                    timeout = int(c[0][1:])
+                except ValueError:
+                    ret.append((None, Command.result(Command.RET_ERR_TYPE, 'invalid timeout `%s\'' % c[0]), None))
+                    continue
+                c = c[1:]
+                if not c:
+                    conn['timeout'] = timeout
+                    ret.append((None, Command.result(Command.RET_SUCCESS), None))
+                    continue
+            ret.append(Command.parse(c, now + timeout / 1000.0 if timeout > 0 else None))
+        return ret
+
+    """
+    run a job on the calling (network) thread; commands flagged as
+    blocking, and commands to be forwarded to another process, which
+    would keep the network thread waiting for the other process's
+    network thread, are handed over to a worker together with
+    everything after them, so that the responses keep their order
+    """
+    def runInline(self, job):
+
+        conn = job['conn']
+        if conn['scheduled'] or job['lane'] == Command.LANE_HEAVY:
+            # a worker still has some of the connection's
+            # (blocking) jobs, keep the responses in order
+            self.assign(job)
+            return
+
+        cmds = job['commands']
+        forwarded = conn['forwarded']
+        for i in xrange(len(cmds)):
+            (cmdInfo, args, deadline) = cmds[i]
+            if cmdInfo and (cmdInfo['blocking'] or cmdInfo['lane'] == Command.LANE_HEAVY or (not forwarded and Shard.remote(cmdInfo, args))):
+                if i > 0:
+                    worker.Worker.runJob(self, {'conn': job['conn'], 'commands': cmds[:i], 'lane': job['lane']})
+                job['commands'] = cmds[i:]
+                self.assign(job)
+                return
+
+        worker.Worker.runJob(self, job)
+
+    """
+    read everything available on the socket (connections are
+    edge-triggered) and split it into commands; the first bytes
+    of a connection pick its protocol
+
+    @return (list of complete commands, each one a list of arguments,
+             number of bytes they took, whether the connection is to
+             be closed)
+    """
+    def read(self, conn):
+
         sock = conn['sock']
         addr = conn['addr']
+        size = self.config['read_size']
 
-        cmd = None
+        chunks = []
+        closed = False
         while True:
             try:
-                cmd = sock.recv(1024)
+                data = sock.recv(size)
             except socket.error, e:
-                if e.args[0] in { errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK }:
-                    # retry on eintr, eagain and ewouldblock
+                if e.args[0] == errno.EINTR:
                     continue
-            break
+                if e.args[0] not in { errno.EAGAIN, errno.EWOULDBLOCK }:
+                    closed = True
+                break
 
-        if not cmd or len(cmd) == 0:
-            # client closed the connection
-            Logger.debug("0 bytes read from " + addr[0] + ":" + str(addr[1]))
-            return False
+            if not data:
+                # client closed the connection
+                Logger.debug("0 bytes read from " + addr[0] + ":" + str(addr[1]))
+                closed = True
+                break
+
+            chunks.append(data)
+            if len(data) < size:
+                # drained; more data will trigger a new edge
+                break
+
+        if not chunks:
+            return ([], 0, closed)
 
         fd = sock.fileno()
         if fd not in self.readBuffer:
             self.readBuffer[fd] = ""
 
-        self.readBuffer[fd] += cmd
+        data = ''.join(chunks)
+        Stats.count('bytes_in', len(data))
+        self.readBuffer[fd] += data
+
+        if conn['protocol'] is None:
+            (conn['protocol'], self.readBuffer[fd]) = protocol.negotiate(self.readBuffer[fd])
 
-        if not Command.SEPARATOR in self.readBuffer[fd]:
-            if len(self.readBuffer[fd]) > Manager.MAX_BUFFER_SIZE:
-                self.readBuffer[fd] = ""
+        # split the buffer into commands and retain
+        # the last partial command if any
+        size = len(self.readBuffer[fd])
+        try:
+            (cmds, self.readBuffer[fd]) = conn['protocol'].split(self.readBuffer[fd])
+        except ProtocolException as e:
+            Logger.warn("closing " + addr[0] + ":" + str(addr[1]) + ": " + str(e))
+            return ([], 0, True)
+        size -= len(self.readBuffer[fd])
+
+        limit = self.config[Manager.SHED_CONNECTION]
+        if limit and len(self.readBuffer[fd]) > limit:
+            # a single command that big is no command
+            Logger.warn("closing " + addr[0] + ":" + str(addr[1]) + ": more than %d bytes without a complete command" % limit)
+            return ([], 0, True)
+
+        return (cmds, size, closed)
+
+    """
+    drop what's left from a closed connection
+    """
+    def forget(self, fd):
+        self.readBuffer.pop(fd, None)
+
+    """
+    queue a job on its connection and, unless the connection is
+    already waiting for or being served by a worker, hand the
+    connection over to a worker, preferably the one it had before
+    """
+    def assign(self, job):
+
+        conn = job['conn']
+        count = len(job['commands'])
+
+        # check the limits; control commands and the ones forwarded
+        # by another process always get through
+        reason = None
+        self.loadLock.acquire()
+        limit = self.config[Manager.SHED_CONNECTION]
+        if not job['lane'] in (Command.LANE_ADMIN, Command.LANE_SHARD):
+            if limit and conn['queued'] + conn['outBytes'] + job['bytes'] > limit:
+                reason = Manager.SHED_CONNECTION
+            elif self.config[Manager.SHED_INFLIGHT] and self.inflight + count > self.config[Manager.SHED_INFLIGHT]:
+                reason = Manager.SHED_INFLIGHT
+        if reason is None:
+            self.inflight += count
+            conn['queued'] += job['bytes']
+            job['inflight'] = count
+        self.loadLock.release()
+
+        if reason:
+            self.refuse(job, reason)
+
+        job['time'] = time.time()
+
+        conn['jobsLock'].acquire()
+        conn['pending'].append(job)
+        scheduled = conn['scheduled']
+        conn['scheduled'] = True
+        conn['jobsLock'].release()
+
+        if scheduled:
             return True
 
-        # split the buffer into commands and feed the workers
-        cmds = self.readBuffer[fd].split(Command.SEPARATOR)
-        
-        # retain the last partial command if any
-        lastcmd = cmds[len(cmds) - 1]
-        self.readBuffer[fd] = lastcmd
+        return self.schedule(conn)
+
+    """
+    turn the commands of a job into busy answers; the job still
+    goes through the connection's queue to keep the responses
+    in order, but costs nothing to run
+    """
+    def refuse(self, job, reason):
+        self.loadLock.acquire()
+        self.shed[reason] += len(job['commands'])
+        self.loadLock.release()
+        job['commands'] = [(None, Command.result(Command.RET_BUSY, reason), None)] * len(job['commands'])
+
+    """
+    account for a job run by a worker
+    """
+    def done(self, job):
+        count = job.pop('inflight', None)
+        if count is None:
+            return False
+        self.loadLock.acquire()
+        self.inflight -= count
+        job['conn']['queued'] -= job['bytes']
+        self.loadLock.release()
+        return True
+
+    """
+    hand a connection with pending jobs over to a worker of the
+    lane of its next job
+    """
+    def schedule(self, conn):
 
-        del cmds[len(cmds) - 1]
+        conn['jobsLock'].acquire()
+        lane = conn['pending'][0]['lane']
+        conn['jobsLock'].release()
 
-        job = {'sock': sock, 'addr': addr, 'commands': cmds}
+        w = conn['workers'].get(lane)
+        if w and w.schedule(conn):
+            return True
+
+        addr = conn['addr']
 
         self.workersLock.acquire()
 
         _served = False
-        # pick a worker to assign the job to
+        # pick a worker to assign the connection to
         try:
-            w = self.pickWorkerUnlocked()
-            if w:
-                w.addJob(job)
+            w = self.pickWorkerUnlocked(lane)
+            if w and w.schedule(conn):
+                conn['workers'][lane] = w
                 _served = True
         except:
             Logger.exception()
 
-        if _served == False:
-            Logger.warn("Connection from " + addr[0] + ":" + str(addr[1]) + " was dropped")
-
         self.workersLock.release()
 
-        return True
+        if _served == False:
+            # nobody can take the connection, answer right away
+            conn['jobsLock'].acquire()
+            jobs = list(conn['pending'])
+            conn['pending'].clear()
+            conn['scheduled'] = False
+            conn['jobsLock'].release()
+            for job in jobs:
+                if self.done(job):
+                    self.refuse(job, Manager.SHED_QUEUE)
+                worker.Worker.runJob(self, job)
+            Logger.warn("Connection from " + addr[0] + ":" + str(addr[1]) + " was refused, all workers are busy")
+
+        return _served
 
         
-    def createWorker(self):
-        w = worker.Worker(self)
+    def createWorker(self, lane):
+        w = worker.Worker(self, lane)
         self.addWorkerUnlocked(w)
         return w
 
     def addWorkerUnlocked(self, w):
-        self.workers.append(w)
+        self.workers[w.lane].append(w)
 
     def removeWorkerUnlocked(self, w):
-        self.workers.remove(w)
+        self.workers[w.lane].remove(w)
 
     """ scale down method; this method's main purpose is to join
     idle worker threads from time to time """
@@ -207,17 +480,25 @@ class Manager(threading.Thread):
 
             self.event.wait(self.config['scale_down_interval'])
 
+            # the workers are joined with the lock released: a worker
+            # still serving a connection may need it to hand the
+            # connection over to another lane (see Worker.serve)
+            stopped = []
             self.workersLock.acquire()
+            for lane in Command.LANES:
+                idleWorkers = self.idleWorkers[lane]
+                while not idleWorkers.empty():
+                    i = idleWorkers.get()
+                    self.removeWorkerUnlocked(i)
+                    idleWorkers.task_done()
+                    stopped.append(i)
+            self.workersLock.release()
 
-            while not self.idleWorkers.empty():
-                i = self.idleWorkers.get()
+            for i in stopped:
                 i.stop()
-                self.removeWorkerUnlocked(i)
-                self.idleWorkers.task_done()
-
-            self.idleWorkers.join()
-
-            self.workersLock.release()
+                # the worker may have got some work in the meantime
+                for conn in i.emptyQueue():
+                    self.schedule(conn)
 
             self.event.clear()
 
@@ -228,7 +509,7 @@ class Manager(threading.Thread):
     def shutdownWorkers(self):
         # we don't need to lock here since
         # we know we're running unlocked
-        for w in self.workers:
+        for w in sum(self.workers.values(), []):
 
             # WARNING: unprocessed commands are dropped
             w.emptyQueue()
@@ -251,5 +532,41 @@ class Manager(threading.Thread):
 
 
     def workersCmd(self, args):
-        return Command.result(Command.RET_SUCCESS, {'active': len(self.workers), 'max': self.config['workers']})
+        lanes = {}
+        for lane in Command.LANES:
+            lanes[lane] = {
+                'active': len(self.workers[lane]),
+                'max': self.config[Manager.BUDGETS[lane]],
+                'queued': sum([w.getQSize() for w in self.workers[lane]])
+            }
+        return Command.result(Command.RET_SUCCESS, {
+            'active': sum([lanes[lane]['active'] for lane in lanes]),
+            'max': sum([lanes[lane]['max'] for lane in lanes]),
+            'lanes': lanes
+        })
 
+    """
+    commands in flight, the limits and the number of commands
+    answered busy because of each one of them
+    """
+    def loadCmd(self, args):
+        self.loadLock.acquire()
+        ret = {
+            'inflight': self.inflight,
+            'limits': dict([(k, self.config[k]) for k in self.shed]),
+            'shed': dict(self.shed)
+        }
+        self.loadLock.release()
+        return Command.result(Command.RET_SUCCESS, ret)
+
+    """
+    idle workers and connections waiting in every worker queue, by lane
+    """
+    def queueStats(self):
+        ret = {}
+        for lane in Command.LANES:
+            ret[lane] = {
+                'idle': self.idleWorkers[lane].qsize(),
+                'queues': [w.getQSize() for w in list(self.workers[lane])]
+            }
+        return ret
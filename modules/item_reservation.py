@@ -1,7 +1,9 @@
 import os
 import sys
 import time
+import random
 import signal
+import heapq
 import threading
 
 from logger import Logger
@@ -9,53 +11,417 @@ from event import Event
 from config import Config
 from command import Command
 from module import Module
+from shard import Shard
+from stats import Stats
+
+# optional, for the columnar store
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Product and reservation records
+
+A catalog holds millions of these, so they use __slots__ instead of
+dicts, client ids are interned (the same client reserves many skus)
+and the reservations dict of a product is only allocated along with
+its first reservation. The db.save / db.load events still exchange
+plain dicts so that the storage formats don't change.
+"""
+
+class Reservation(object):
+
+    __slots__ = ('qty', 'timestamp', 'ttl', 'deadline')
+
+    def __init__(self, qty = 0, timestamp = 0, ttl = None):
+        self.qty = qty
+        # when the reservation was last updated
+        self.timestamp = timestamp
+        # ttl override, None for the default ttl
+        self.ttl = ttl
+        # timestamp + ttl, the moment the reservation expires
+        self.deadline = None
+
+    def toDict(self):
+        return {'qty': self.qty, 'timestamp': self.timestamp, 'ttl': self.ttl}
+
+    @staticmethod
+    def fromDict(rdata):
+        return Reservation(rdata['qty'], rdata['timestamp'], rdata.get('ttl'))
+
+
+"""
+The stock and the total reservations of a product are published
+together, along with a version, as an immutable (stock, total
+reservations, version) tuple: readers get a consistent state with a
+single attribute read, without locking. Writers hold the product's
+lock and every publication bumps the version.
+
+Versions start at the startup time in microseconds, so that they keep
+growing across restarts and clients can tell whether the product
+changed since they read it.
+"""
+
+class ProductRecord(object):
+
+    __slots__ = ('state', 'reservations')
+
+    # first version of the products
+    epoch = int(time.time() * 1000000)
+
+    def __init__(self, stock, totalReservations = 0, reservations = None):
+        self.state = (stock, totalReservations, ProductRecord.epoch)
+        # client id -> Reservation, None until the first reservation
+        self.reservations = reservations
+
+    """
+    publish a new state; must be called with the product locked
+    """
+    def publish(self, stock, totalReservations):
+        self.state = (stock, totalReservations, self.state[2] + 1)
+
+    def getStock(self):
+        return self.state[0]
+
+    def setStock(self, value):
+        self.publish(value, self.state[1])
+
+    def getTotalReservations(self):
+        return self.state[1]
+
+    def setTotalReservations(self, value):
+        self.publish(self.state[0], value)
+
+    stock = property(getStock, setStock)
+    totalReservations = property(getTotalReservations, setTotalReservations)
+
+    @property
+    def version(self):
+        return self.state[2]
+
+    def reservationsDict(self):
+        if not self.reservations:
+            return {}
+        return dict([(clid, self.reservations[clid].toDict()) for clid in self.reservations])
+
+
+"""
+Columnar store
+
+With `store = columnar' the stock, the total reservations and the time
+of the last update of the products live in NumPy arrays, one row per
+product, so that catalog wide operations (see the stock.reset,
+stock.cut, stock.summary and stock.stale commands) are vectorized
+instead of looping over the products.
+
+Rows are allocated in blocks of BLOCK rows; a block never moves once
+allocated, so adding products doesn't disturb the readers and writers
+of the existing ones. Products are never removed, neither are rows.
+"""
+
+class Columns:
+
+    # whether the columnar store is used
+    active = False
+
+    # rows per block, a power of 2
+    SHIFT = 16
+    BLOCK = 1 << SHIFT
+    MASK = BLOCK - 1
+
+    # lists of blocks
+    stock = []
+    reserved = []
+    updated = []
+
+    # row -> sku
+    skus = []
+
+    # allocated rows
+    rows = 0
+
+    # products of different stripes may be added at the same time
+    lock = threading.Lock()
+
+    """
+    allocate the row of a new product
+    """
+    @staticmethod
+    def allocate(sku):
+        Columns.lock.acquire()
+        row = Columns.rows
+        if row >> Columns.SHIFT == len(Columns.stock):
+            Columns.stock.append(numpy.zeros(Columns.BLOCK, numpy.int64))
+            Columns.reserved.append(numpy.zeros(Columns.BLOCK, numpy.int64))
+            Columns.updated.append(numpy.zeros(Columns.BLOCK, numpy.float64))
+        Columns.skus.append(sku)
+        Columns.rows += 1
+        Columns.lock.release()
+        return row
+
+    """
+    iterate over the allocated part of every block
+
+    @return (first row of the block, stock, reserved, updated) views
+    """
+    @staticmethod
+    def blocks():
+        rows = Columns.rows
+        for b in xrange(len(Columns.stock)):
+            start = b << Columns.SHIFT
+            count = min(rows - start, Columns.BLOCK)
+            if count <= 0:
+                break
+            yield (start, Columns.stock[b][:count], Columns.reserved[b][:count], Columns.updated[b][:count])
+
+
+"""
+A product whose published states are copied to its row in Columns;
+single product reads still use the state
+"""
+
+class ColumnarRecord(ProductRecord):
+
+    __slots__ = ('row', )
+
+    def __init__(self, sku, stock, totalReservations = 0, reservations = None):
+        self.row = Columns.allocate(sku)
+        ProductRecord.__init__(self, stock, totalReservations, reservations)
+        self.store()
+
+    def publish(self, stock, totalReservations):
+        ProductRecord.publish(self, stock, totalReservations)
+        self.store()
+
+    def store(self):
+        (b, i) = (self.row >> Columns.SHIFT, self.row & Columns.MASK)
+        Columns.stock[b][i] = self.state[0]
+        Columns.reserved[b][i] = self.state[1]
+        Columns.updated[b][i] = time.time()
+
+
+"""
+Striped lock table
+
+Products don't have a lock of their own: the hash of a sku picks one
+of a fixed number of stripes, each one with a lock. The locks aren't
+reentrant and a thread must never hold two stripes at once, since two
+products may share a stripe.
+
+Acquisitions, and the ones that had to wait because the stripe was
+held, are counted per stripe; both counters are updated with the
+stripe held, so they're exact.
+"""
+
+class LockTable:
+
+    def __init__(self, stripes):
+        # round up to a power of 2 so that a mask picks the stripe
+        count = 1
+        while count < stripes:
+            count <<= 1
+        self.mask = count - 1
+        self.locks = [threading.Lock() for i in xrange(count)]
+        self.acquired = [0] * count
+        self.waited = [0] * count
+
+    def __len__(self):
+        return len(self.locks)
+
+    def stripe(self, sku):
+        return hash(sku) & self.mask
+
+    def acquire(self, sku):
+        self.acquireStripe(hash(sku) & self.mask)
+
+    def release(self, sku):
+        self.locks[hash(sku) & self.mask].release()
+
+    def acquireStripe(self, i):
+        lock = self.locks[i]
+        if not lock.acquire(False):
+            lock.acquire()
+            self.waited[i] += 1
+        self.acquired[i] += 1
+
+    def releaseStripe(self, i):
+        self.locks[i].release()
+
+    """
+    @param top Number of most waited for stripes to list
+    """
+    def summary(self, top = 8):
+        waited = list(self.waited)
+        hottest = sorted([i for i in xrange(len(waited)) if waited[i]], key = lambda i: waited[i], reverse = True)[:top]
+        return {
+            'stripes': len(self.locks),
+            'acquired': sum(self.acquired),
+            'waited': sum(waited),
+            'hottest': [{'stripe': i, 'acquired': self.acquired[i], 'waited': waited[i]} for i in hottest]
+        }
+
+    def reset(self):
+        self.acquired = [0] * len(self.locks)
+        self.waited = [0] * len(self.locks)
+
 
 class Product:
      
-    # product data
-    # sku1
-    #   -> totalReservations
-    #   -> reservations
-    #       -> clid1
-    #           -> qty: quantity 
-    #           -> timestamp: timestamp when the reservation was updated
-    #       -> clid2 ...
-    #   -> stock
-    #   -> lock
-    # sku2 ...
+    # product data, sku -> ProductRecord
     data = {}
 
-    # big lock used around all products when saving or loading the database
-    # this does not actually impact commands altering the product, it only
-    # affects adding new products or saving and loading the db in the same time
+    # product locks, see LockTable; replaced according to the
+    # configuration by init()
+    locks = LockTable(1024)
+
+    # default configuration values
+    DEFAULTS = {
+        'store': 'dict',
+        'lock_stripes': 1024,
+        'load_cpu_share': 0.5
+    }
+
+    # configuration
+    config = {}
+
+    # products stock.load handles between two checks of its cpu share
+    LOAD_SLICE = 500
+
+    # big lock keeping the catalog wide operations (saving, loading, bulk
+    # stock updates) from running at the same time; commands altering
+    # or adding a single product don't need it
     bigLock = threading.RLock()
+
+    # skus modified since the last save, None if nobody needs to know
+    dirty = None
+
+    # protects the dirty set
+    dirtyLock = threading.Lock()
     
     @staticmethod
     def init():
 
+        Product.loadStartupConfig()
+        Product.loadConfig()
+
         commands = {
-            'product.add': {'handler': Product.productAddCmd, 'args':2, 'help':'productAdd sku stock'},
-            'product.info': {'handler': Product.productInfoCmd, 'args':1, 'help':'productInfo sku'},
-            'reservation.add': {'handler': Product.reservationAddCmd, 'args':3, 'help':'reservationAdd client_id sku qty'},
-            'reservation.del': {'handler': Product.reservationDelCmd, 'args':3, 'help':'reservationDel client_id sku qty'},
-            'reservation.set': {'handler': Product.reservationSetCmd, 'args':3, 'help':'reservationSet client_id sku qty'},
-            'stock.set': {'handler': Product.stockSetCmd, 'args':2, 'help':'stockSet sku stock'},
-            'stock.dec': {'handler': Product.stockDecCmd, 'args':2, 'help':'stockDec sku qty'},
-            'stock.get': {'handler': Product.stockGetCmd, 'args':1, 'help':'stockGet sku'},
-            'product.total': {'handler': Product.totalCmd, 'args':0, 'help':'status'}
+            'product.add': {'handler': Product.productAddCmd, 'args':2, 'help':'productAdd sku stock', 'key':0, 'opcode':20, 'schema':[('sku', str), ('stock', int)]},
+            'product.info': {'handler': Product.productInfoCmd, 'args':1, 'help':'productInfo sku', 'key':0, 'opcode':21, 'schema':[('sku', str)]},
+            'reservation.add': {'handler': Product.reservationAddCmd, 'args':3, 'help':'reservationAdd client_id sku qty', 'key':1, 'opcode':40, 'schema':[('client_id', str), ('sku', str), ('qty', int)]},
+            'reservation.del': {'handler': Product.reservationDelCmd, 'args':3, 'help':'reservationDel client_id sku qty', 'key':1, 'opcode':41, 'schema':[('client_id', str), ('sku', str), ('qty', int)]},
+            'reservation.set': {'handler': Product.reservationSetCmd, 'args':3, 'help':'reservationSet client_id sku qty', 'key':1, 'opcode':42, 'schema':[('client_id', str), ('sku', str), ('qty', int)]},
+            'reservation.ttl': {'handler': Product.reservationTtlCmd, 'args':3, 'help':'reservationTtl client_id sku ttl', 'key':1, 'opcode':43, 'schema':[('client_id', str), ('sku', str), ('ttl', int)]},
+            'stock.set': {'handler': Product.stockSetCmd, 'args':2, 'help':'stockSet sku stock', 'key':0, 'opcode':30, 'schema':[('sku', str), ('stock', int)]},
+            'stock.dec': {'handler': Product.stockDecCmd, 'args':2, 'help':'stockDec sku qty', 'key':0, 'opcode':31, 'schema':[('sku', str), ('qty', int)]},
+            'stock.get': {'handler': Product.stockGetCmd, 'args':1, 'help':'stockGet sku', 'key':0, 'opcode':32, 'schema':[('sku', str)]},
+            'product.total': {'handler': Product.totalCmd, 'args':0, 'help':'status', 'fanout':Shard.sum, 'opcode':22, 'lane':Command.LANE_ADMIN},
+            'stock.load': {'handler': Product.stockLoadCmd, 'args':1, 'help':'stockLoad sku:stock,sku:stock,...', 'fanout':Shard.sum, 'opcode':37, 'schema':[('items', str)], 'lane':Command.LANE_HEAVY}
         }
 
+        if Columns.active:
+            commands.update({
+                'stock.reset': {'handler': Product.stockResetCmd, 'args':1, 'help':'stockReset stock', 'fanout':Shard.sum, 'opcode':33, 'schema':[('stock', int)], 'lane':Command.LANE_HEAVY},
+                'stock.cut': {'handler': Product.stockCutCmd, 'args':1, 'help':'stockCut percent', 'fanout':Shard.sum, 'opcode':34, 'schema':[('percent', int)], 'lane':Command.LANE_HEAVY},
+                'stock.summary': {'handler': Product.stockSummaryCmd, 'args':0, 'help':'stockSummary', 'fanout':Shard.sum, 'opcode':35, 'lane':Command.LANE_ADMIN},
+                'stock.stale': {'handler': Product.stockStaleCmd, 'args':1, 'help':'stockStale seconds', 'fanout':Shard.sum, 'opcode':36, 'schema':[('seconds', int)], 'lane':Command.LANE_ADMIN}
+            })
+
 
         for c in commands:
             Command.register(
                 commands[c]['handler'], 
                 c, 
                 commands[c]['args'], 
-                commands[c]['help']
+                commands[c]['help'],
+                key = commands[c].get('key'),
+                fanout = commands[c].get('fanout'),
+                opcode = commands[c]['opcode'],
+                schema = commands[c].get('schema'),
+                lane = commands[c].get('lane')
             )
 
         Event.register('db.save', Product.saveDb)
+        Event.register('db.snapshot', Product.snapshotDb)
         Event.register('db.load', Product.loadDb)
+        Event.register('db.replay', Product.replayDb)
+        Event.register('db.loaded', Product.loadedDb)
+        Event.register('db.track', Product.trackDb)
+        Event.register('core.reload', Product.reloadEvent)
+        Event.register('core.stats', Product.statsEvent)
+        Event.register('core.stats.reset', Product.statsResetEvent)
+
+    """
+    The store and the locks can't be changed by a reload, they're
+    set up at startup
+    """
+    @staticmethod
+    def loadStartupConfig():
+        Product.locks = LockTable(Config.getint('products', 'lock_stripes', Product.DEFAULTS['lock_stripes']))
+
+        store = Config.get('products', 'store', Product.DEFAULTS['store'])
+        if store == 'columnar':
+            if numpy is None:
+                Logger.error('the columnar store needs NumPy, using the dict store')
+            else:
+                Columns.active = True
+        elif store != 'dict':
+            Logger.error('unknown store `%s\', using the dict store' % store)
+
+    @staticmethod
+    def loadConfig():
+        share = Config.getfloat('products', 'load_cpu_share', Product.DEFAULTS['load_cpu_share'])
+        if share <= 0 or share > 1:
+            Logger.error('load_cpu_share must be in ]0, 1], using %s' % Product.DEFAULTS['load_cpu_share'])
+            share = Product.DEFAULTS['load_cpu_share']
+        Product.config['load_cpu_share'] = share
+
+    @staticmethod
+    def reloadEvent(*args):
+        Product.loadConfig()
+
+    """
+    Add the lock counters to core.stats
+    """
+    @staticmethod
+    def statsEvent(stats):
+        stats['locks'] = Product.locks.summary()
+
+    @staticmethod
+    def statsResetEvent(*args):
+        Product.locks.reset()
+
+    """
+    Create the record of a new product
+    """
+    @staticmethod
+    def newRecord(sku, stock, totalReservations = 0, reservations = None):
+        if Columns.active:
+            return ColumnarRecord(sku, stock, totalReservations, reservations)
+        return ProductRecord(stock, totalReservations, reservations)
+
+    """
+    Create a record from the dict format of the db.load event
+    """
+    @staticmethod
+    def recordFromDict(sku, pdata):
+        return Product.newRecord(sku, pdata['stock'], pdata['totalReservations'], Product.reservationsFromDict(pdata['reservations']))
+
+    @staticmethod
+    def reservationsFromDict(reservations):
+        if not reservations:
+            return None
+        return dict([(intern(str(clid)), Reservation.fromDict(r)) for (clid, r) in reservations.iteritems()])
+
+    """
+    Create the reservations of a snapshot row, i.e. (client id, qty,
+    timestamp, ttl override or 0) tuples (see snapshot.py)
+    """
+    @staticmethod
+    def reservationsFromRows(rows):
+        if not rows:
+            return None
+        return dict([(intern(clid), Reservation(qty, timestamp, ttl or None)) for (clid, qty, timestamp, ttl) in rows])
 
     """
     Prepare data to be written in the database
@@ -63,57 +429,209 @@ class Product:
     @staticmethod
     def saveDb(data):
         dbdata = {}
+
+        # skus modified before this point are part of this save
+        Product.dirtyLock.acquire()
+        dirty = Product.dirty
+        if dirty is not None:
+            Product.dirty = set()
+        Product.dirtyLock.release()
+
+        if data.get('incremental') and dirty is not None:
+            skus = dirty
+        else:
+            skus = None
+
         Product.lockAll()
-        for sku in Product.data:
-            Product.lock(sku)
+        for (sku, pdata) in Product.walk(skus):
             dbdata[sku] = {
-                'totalReservations': Product.data[sku]['totalReservations'],
-                'reservations': dict(Product.data[sku]['reservations']),
-                'stock': Product.data[sku]['stock']
+                'totalReservations': pdata.totalReservations,
+                'reservations': pdata.reservationsDict(),
+                'stock': pdata.stock
             }
-            Product.unlock(sku)
         Product.unlockAll()
         data['products'] = dbdata
         return True
 
     """
-    Interpret loaded db data and fill in product data
+    Start or stop tracking the skus modified between two saves
+    """
+    @staticmethod
+    def trackDb(enabled):
+        Product.dirtyLock.acquire()
+        if enabled:
+            if Product.dirty is None:
+                Product.dirty = set()
+        else:
+            Product.dirty = None
+        Product.dirtyLock.release()
+
+    """
+    Same as saveDb, called from a forked child where nothing else
+    runs; locks held by other threads at fork time are never
+    released in here, so no locking. A reservation update may have
+    been caught halfway, hence the totals are recomputed (the journal
+    has the update anyway)
+    """
+    @staticmethod
+    def snapshotDb(data):
+        dbdata = {}
+        for sku in Product.data:
+            pdata = Product.data[sku]
+            reservations = pdata.reservationsDict()
+            dbdata[sku] = {
+                'totalReservations': sum([reservations[clid]['qty'] for clid in reservations]),
+                'reservations': reservations,
+                'stock': pdata.stock
+            }
+        data['products'] = dbdata
+        return True
+
+    """
+    Interpret loaded db data and fill in product data; products come
+    either in the dict format or as snapshot rows
     """
     @staticmethod
     def loadDb(data):
-        
-        Product.lockAll()
+
+        if 'rows' in data:
+            Product.loadRows(data['rows'])
+            return True
 
         if not 'products' in data:
             return False
+
+        Product.lockAll()
         
         products = data['products']
         for sku in products:
-            if Product.lock(sku) == False:
-                # adding a new product
-                Product.productAdd(sku, products[sku]['stock'])
-                Product.lock(sku)
-           
-            Product.data[sku]['reservations'] = dict(products[sku]['reservations'])
-            Product.data[sku]['totalReservations'] = products[sku]['totalReservations']
-            Product.data[sku]['stock'] = products[sku]['stock']
-            
-            Product.unlock(sku)
+            Product.locks.acquire(sku)
+            pdata = Product.data.get(sku)
+            if pdata is None:
+                key = intern(str(sku))
+                Product.data[key] = Product.recordFromDict(key, products[sku])
+            else:
+                Product.unscheduleAllUnlocked(pdata)
+                pdata.reservations = Product.reservationsFromDict(products[sku]['reservations'])
+                pdata.publish(products[sku]['stock'], products[sku]['totalReservations'])
+            Product.locks.release(sku)
+
+        Product.unlockAll()
+
+    @staticmethod
+    def loadRows(rows):
+
+        Product.lockAll()
+
+        for (sku, stock, total, reservations) in rows:
+            Product.locks.acquire(sku)
+            pdata = Product.data.get(sku)
+            if pdata is None:
+                key = intern(sku)
+                Product.data[key] = Product.newRecord(key, stock, total, Product.reservationsFromRows(reservations))
+            else:
+                Product.unscheduleAllUnlocked(pdata)
+                pdata.reservations = Product.reservationsFromRows(reservations)
+                pdata.publish(stock, total)
+            Product.locks.release(sku)
 
         Product.unlockAll()
 
+    """
+    the reservations of a product are about to be replaced
+    """
+    @staticmethod
+    def unscheduleAllUnlocked(pdata):
+        for rdata in (pdata.reservations or {}).itervalues():
+            DeadlineIndex.unschedule(rdata)
+
+    """
+    Apply a journal record on top of the loaded data; records carry
+    the resulting state so applying one twice is harmless
+    """
+    @staticmethod
+    def replayDb(record):
+
+        op = record[0]
+        sku = record[1]
+
+        if op == 'product.add':
+            if not sku in Product.data:
+                Product.productAdd(sku, record[2])
+            return
+
+        if not sku in Product.data:
+            Logger.warn('journal record for unknown product %s' % sku)
+            return
+
+        pdata = Product.data[sku]
+        if op == 'stock.set':
+            pdata.stock = record[2]
+
+        elif op == 'reservation.set':
+            (clid, qty, timestamp, ttl) = record[2:]
+            if pdata.reservations is None:
+                pdata.reservations = {}
+            rdata = pdata.reservations.get(clid)
+            if not rdata:
+                rdata = pdata.reservations[intern(str(clid))] = Reservation()
+            pdata.totalReservations += qty - rdata.qty
+            rdata.qty = qty
+            rdata.timestamp = timestamp
+            rdata.ttl = ttl
+            if rdata.deadline is not None:
+                DeadlineIndex.schedule(sku, clid, rdata)
+
+        elif op == 'reservation.expire':
+            clid = record[2]
+            if pdata.reservations and clid in pdata.reservations:
+                pdata.totalReservations -= pdata.reservations[clid].qty
+                DeadlineIndex.unschedule(pdata.reservations[clid])
+                del pdata.reservations[clid]
+
+    """
+    The database and the journal were loaded
+    """
+    @staticmethod
+    def loadedDb(data):
+        # older databases and journal records don't carry deadlines
+        DeadlineIndex.rebuild()
+
+    """
+    A product was modified; record[1] is always the sku. The sku is
+    flagged as dirty before the record reaches the journal so that a
+    save truncating the journal always includes the change
+    (see journal.py for the records)
+    """
+    @staticmethod
+    def changed(record):
+        if Product.dirty is not None:
+            Product.dirtyLock.acquire()
+            if Product.dirty is not None:
+                Product.dirty.add(record[1])
+            Product.dirtyLock.release()
+        ChangeFeed.append(record[1])
+        Watch.changed(record[1])
+        Event.dispatch('db.journal', record)
+
+    """
+    Lock the stripe of a product; products are never removed, so
+    the product is still there once locked
+
+    @return False if the product doesn't exist (nothing is locked)
+    """
     @staticmethod
     def lock(sku):
         if not sku in Product.data:
             return False
-        Product.data[sku]['lock'].acquire()
+        Product.locks.acquire(sku)
         return True
 
     @staticmethod
     def unlock(sku):
         if not sku in Product.data:
             return False
-        Product.data[sku]['lock'].release()
+        Product.locks.release(sku)
         return True
 
     @staticmethod
@@ -124,41 +642,108 @@ class Product:
     def unlockAll():
         Product.bigLock.release()
 
+    """
+    Visit products one stripe at a time, the stripe being locked
+    meanwhile, so that walking the whole catalog only ever holds up
+    the commands of a single stripe. Products added once the walk
+    started may be missed. The caller must not lock products.
+
+    @param skus Skus to visit, all the products by default
+    @return generator of (sku, product record)
+    """
+    @staticmethod
+    def walk(skus = None):
+        if skus is None:
+            # a copy, products may be added meanwhile
+            skus = Product.data.keys()
+        stripes = {}
+        for sku in skus:
+            stripes.setdefault(Product.locks.stripe(sku), []).append(sku)
+        for i in stripes:
+            Product.locks.acquireStripe(i)
+            try:
+                for sku in stripes[i]:
+                    pdata = Product.data.get(sku)
+                    if pdata is not None:
+                        yield (sku, pdata)
+            finally:
+                Product.locks.releaseStripe(i)
+
     @staticmethod
     def getProducts():
-        Product.lockAll()
-        for sku in Product.data:
-            Product.lock(sku)
-            yield [sku, Product.data[sku]]
-            Product.unlock(sku)
-        Product.unlockAll()
+        for (sku, pdata) in Product.walk():
+            yield [sku, pdata]
 
     @staticmethod
     def getReservations(sku):
         Product.lock(sku)
-        for clid in Product.data[sku]['reservations']:
-            yield [clid, Product.data[sku][clid]]
+        reservations = Product.data[sku].reservations or {}
+        for clid in reservations:
+            yield [clid, reservations[clid]]
         Product.unlock(sku)
 
+    """
+    @return the Reservation of a client, None if there's none
+    """
+    @staticmethod
+    def reservationGetUnlocked(sku, clid):
+        reservations = Product.data[sku].reservations
+        return reservations.get(clid) if reservations else None
+
     @staticmethod
     def reservationGetTimeUnlocked(sku, clid):
-        return Product.data[sku]['reservations'][clid]['timestamp']
+        return Product.data[sku].reservations[clid].timestamp
 
     @staticmethod
     def reservationGetQtyUnlocked(sku, clid):
-        return Product.data[sku]['reservations'][clid]['qty']
+        return Product.data[sku].reservations[clid].qty
 
     @staticmethod
     def reservationDelUnlocked(sku, clid):
-        del Product.data[sku]['reservations'][clid]
+        pdata = Product.data[sku]
+        del pdata.reservations[clid]
+        if not pdata.reservations:
+            pdata.reservations = None
+        Product.changed(('reservation.expire', sku, clid))
+
+    @staticmethod
+    def reservationJournalUnlocked(sku, clid):
+        rdata = Product.data[sku].reservations[clid]
+        Product.changed(('reservation.set', sku, clid, rdata.qty, rdata.timestamp, rdata.ttl))
+
+    """
+    Create an empty reservation if the client doesn't have one yet
+
+    @return True if the reservation was created
+    """
+    @staticmethod
+    def reservationInitUnlocked(sku, clid):
+        pdata = Product.data[sku]
+        if pdata.reservations is None:
+            pdata.reservations = {}
+        elif clid in pdata.reservations:
+            return False
+        pdata.reservations[intern(clid)] = Reservation()
+        # schedule it right away so that empty reservations expire too
+        Product.reservationTouchUnlocked(sku, clid)
+        return True
+
+    """
+    Refresh the reservation's timestamp and (re)schedule its expiration
+    """
+    @staticmethod
+    def reservationTouchUnlocked(sku, clid):
+        rdata = Product.data[sku].reservations[clid]
+        rdata.timestamp = time.time()
+        DeadlineIndex.schedule(sku, clid, rdata)
 
     @staticmethod
     def totalReservationsDecUnlocked(sku, qty):
-        Product.data[sku]['totalReservations'] -= qty
+        Product.data[sku].totalReservations -= qty
 
     @staticmethod
     def totalReservationsIncUnlocked(sku, qty):
-        Product.data[sku]['totalReservations'] += qty
+        Product.data[sku].totalReservations += qty
 
 
     """ ---------------------- COMMANDS ---------------------- """
@@ -170,7 +755,7 @@ class Product:
     def productAddCmd(args):
 
         sku = args[0]
-        stock = int(args[1])
+        stock = args[1]
 
         if Product.productAdd(sku, stock):
             Logger.debug("product %s with stock %d was added" % (sku, stock))
@@ -186,7 +771,7 @@ class Product:
     def stockSetCmd(args):
         
         sku = args[0]
-        qty = int(args[1])
+        qty = args[1]
 
         if Product.stockSet(sku, qty):
             return Command.result(Command.RET_SUCCESS)
@@ -200,7 +785,7 @@ class Product:
     def stockGetCmd(args):
 
         stock = Product.stockGet(args[0])
-        if not stock:
+        if stock is None:
             return Command.result(Command.RET_ERR_GENERAL, 'product not found')
         else:
             return Command.result(Command.RET_SUCCESS, stock)
@@ -212,7 +797,7 @@ class Product:
     def stockDecCmd(args):
 
         sku = args[0]
-        qty = int(args[1])
+        qty = args[1]
 
         ret = Product.stockDec(sku, qty)
         if ret > -1:
@@ -228,7 +813,7 @@ class Product:
 
         clid = args[0]
         sku = args[1]
-        qty = int(args[2])
+        qty = args[2]
 
         ret = Product.reservationAdd(sku, clid, qty)
         if ret > -1:
@@ -243,7 +828,7 @@ class Product:
     def reservationDelCmd(args):
        clid = args[0]
        sku = args[1]
-       qty = int(args[2])
+       qty = args[2]
        Product.reservationDel(sku, clid, qty)
        return Command.result(Command.RET_SUCCESS)
 
@@ -254,14 +839,26 @@ class Product:
     def reservationSetCmd(args):
        clid = args[0]
        sku = args[1]
-       qty = int(args[2])
-       Product.reservationSet(sku, clid, qty)
+       qty = args[2]
        ret = Product.reservationSet(sku, clid, qty)
        if ret > 0:
            return Command.result(Command.RET_ERR_GENERAL, 'not enough stock (stock: ' + str(ret) + ')')
        else:
            return Command.result(Command.RET_SUCCESS)
 
+    """
+    reservationTtl command; a ttl of 0 falls back to the default ttl
+    """
+    @staticmethod
+    def reservationTtlCmd(args):
+       clid = args[0]
+       sku = args[1]
+       ttl = args[2]
+       if Product.reservationTtl(sku, clid, ttl):
+           return Command.result(Command.RET_SUCCESS)
+       else:
+           return Command.result(Command.RET_ERR_GENERAL, 'reservation not found')
+
     """
     get info on a product
     """
@@ -283,26 +880,74 @@ class Product:
         }
         return Command.result(Command.RET_SUCCESS, ret)
 
+    """
+    stockLoad command: add or update the stock of many products at once
+    """
+    @staticmethod
+    def stockLoadCmd(args):
+        try:
+            items = Product.parseLoadItems(args[0])
+        except ValueError as e:
+            return Command.result(Command.RET_ERR_TYPE, str(e))
+        if Shard.enabled():
+            # the command is fanned out, every process takes its own products
+            items = [item for item in items if Shard.owner(item[0]) == Shard.index]
+        return Command.result(Command.RET_SUCCESS, Product.stockLoad(items))
+
+    """
+    set the stock of every product (columnar store only)
+    """
+    @staticmethod
+    def stockResetCmd(args):
+        stock = args[0]
+        if stock < 0:
+            return Command.result(Command.RET_ERR_TYPE, 'stock must not be negative')
+        updated = Product.stockBulk(lambda current: numpy.full_like(current, stock))
+        return Command.result(Command.RET_SUCCESS, {'updated': updated})
 
+    """
+    take a percentage off the stock of every product, rounding the
+    cut down (columnar store only)
+    """
+    @staticmethod
+    def stockCutCmd(args):
+        percent = args[0]
+        if percent < 0 or percent > 100:
+            return Command.result(Command.RET_ERR_TYPE, 'percent must be between 0 and 100')
+        updated = Product.stockBulk(lambda current: current - current * percent // 100)
+        return Command.result(Command.RET_SUCCESS, {'updated': updated})
 
+    """
+    catalog wide availability figures (columnar store only)
+    """
+    @staticmethod
+    def stockSummaryCmd(args):
+        return Command.result(Command.RET_SUCCESS, Product.stockSummary())
 
     """
-    Add a product to the library.
-    We create a lock for it 
+    count the products not updated for some seconds (columnar store only)
+    """
+    @staticmethod
+    def stockStaleCmd(args):
+        return Command.result(Command.RET_SUCCESS, {'stale': Product.stockStale(time.time() - args[0])})
+
+
+
+
+    """
+    Add a product to the library; only its stripe is locked
     """
     @staticmethod
     def productAdd(sku, stock):
-        Product.lockAll()
+        Product.locks.acquire(sku)
         if not sku in Product.data:
-            Product.data[sku] = {
-                'reservations': {},
-                'totalReservations': 0,
-                'stock': stock,
-                'lock': threading.RLock()
-            }
+            # interned so that the deadline index shares the key
+            sku = intern(sku)
+            Product.data[sku] = Product.newRecord(sku, stock)
+            Product.changed(('product.add', sku, stock))
         else:
             Logger.warn('product %s already exists' % sku)
-        Product.unlockAll()
+        Product.locks.release(sku)
         return True
 
     """
@@ -310,8 +955,13 @@ class Product:
     """
     @staticmethod
     def stockSet(sku, stock):
-        # direct list assignement is atomic
-        Product.data[sku]['stock'] = stock
+        # the assignment itself is atomic, the lock keeps
+        # the journal records in the same order as the updates
+        if not Product.lock(sku):
+            return False
+        Product.data[sku].stock = stock
+        Product.changed(('stock.set', sku, stock))
+        Product.unlock(sku)
         return True
     
     """
@@ -326,10 +976,10 @@ class Product:
             return -1
 
         # -= is non atomic, needs locking
-        Product.data[sku]['stock'] -= stock
-        if Product.data[sku]['stock'] < 0:
-            Product.data[sku]['stock'] = 0
-        ret = Product.data[sku]['stock']
+        pdata = Product.data[sku]
+        pdata.stock = max(pdata.stock - stock, 0)
+        ret = pdata.stock
+        Product.changed(('stock.set', sku, ret))
 
         Product.unlock(sku)
 
@@ -340,7 +990,8 @@ class Product:
     """
     @staticmethod
     def stockGet(sku):
-        return Product.data[sku]['stock'] if sku in Product.data else None
+        pdata = Product.data.get(sku)
+        return pdata.state[0] if pdata else None
 
 
     """
@@ -357,12 +1008,17 @@ class Product:
         if Product.lock(sku) == False:
             return 0
         
+        created = Product.reservationInitUnlocked(sku, clid)
+
         stock = Product.stockGet(sku)
 
-        if Product.data[sku]['totalReservations'] + qty <= stock:
-            Product.data[sku]['reservations'][clid]['qty'] += qty
-            Product.data[sku]['reservations'][clid]['timestamp'] = time.time()
-            Product.data[sku]['totalReservations'] += qty
+        pdata = Product.data[sku]
+        if pdata.totalReservations + qty <= stock:
+            pdata.reservations[clid].qty += qty
+            if not created:
+                Product.reservationTouchUnlocked(sku, clid)
+            pdata.totalReservations += qty
+            Product.reservationJournalUnlocked(sku, clid)
         else:
             ret = stock
 
@@ -379,14 +1035,18 @@ class Product:
         if Product.lock(sku) == False:
             return False
        
+        rdata = Product.reservationGetUnlocked(sku, clid)
+        if not rdata:
+            Product.unlock(sku)
+            return False
 
-        Product.data[sku]['totalReservations'] -= qty
-        if Product.data[sku]['totalReservations'] < 0 :
-            Product.data[sku]['totalReservations'] = 0
-        Product.data[sku]['reservations'][clid]['qty'] -= qty
-        Product.data[sku]['reservations'][clid]['timestamp'] = time.time()
-        if Product.data[sku]['reservations'][clid]['qty'] < 0:
-            Product.data[sku]['reservations'][clid]['qty'] = 0
+        pdata = Product.data[sku]
+        pdata.totalReservations = max(pdata.totalReservations - qty, 0)
+        rdata.qty -= qty
+        Product.reservationTouchUnlocked(sku, clid)
+        if rdata.qty < 0:
+            rdata.qty = 0
+        Product.reservationJournalUnlocked(sku, clid)
 
         Product.unlock(sku)
 
@@ -400,17 +1060,21 @@ class Product:
         
         ret = 0
 
-        Product.lock(sku)
+        if Product.lock(sku) == False:
+            return 0
        
-        Product._initProductUnlocked(sku, clid)
+        created = Product.reservationInitUnlocked(sku, clid)
 
         stock = Product.stockGet(sku)
 
-        diff = qty - Product.data[sku]['reservations'][clid]['qty']
-        if Product.data[sku]['totalReservations'] + diff <= stock:
-            Product.data[sku]['reservations'][clid]['qty'] = qty
-            Product.data[sku]['reservations'][clid]['timestamp'] = time.time()
-            Product.data[sku]['totalReservations'] += diff
+        pdata = Product.data[sku]
+        diff = qty - pdata.reservations[clid].qty
+        if pdata.totalReservations + diff <= stock:
+            pdata.reservations[clid].qty = qty
+            if not created:
+                Product.reservationTouchUnlocked(sku, clid)
+            pdata.totalReservations += diff
+            Product.reservationJournalUnlocked(sku, clid)
         else:
             ret = stock
 
@@ -419,20 +1083,326 @@ class Product:
 
         return ret
 
+    """
+    Override the ttl of a single reservation; the reservation
+    is rescheduled relative to its last update
+    """
+    @staticmethod
+    def reservationTtl(sku, clid, ttl):
+
+        if Product.lock(sku) == False:
+            return False
+
+        rdata = Product.reservationGetUnlocked(sku, clid)
+        ret = rdata is not None
+        if ret:
+            rdata.ttl = ttl if ttl > 0 else None
+            DeadlineIndex.schedule(sku, clid, rdata)
+            Product.reservationJournalUnlocked(sku, clid)
+
+        Product.unlock(sku)
+
+        return ret
+
 
     """
     Get info on a product
     """
     @staticmethod
     def info(sku):
-        if not sku in Product.data:
+        pdata = Product.data.get(sku)
+        if not pdata:
             return None
-        # TODO: should we really lock?
+        # no locking, the state is consistent
+        (stock, reservations, version) = pdata.state
         return {
-            'stock': Product.stockGet(sku),
-            'reservations': Product.data[sku]['totalReservations'] if sku in Product.data else 0
+            'stock': stock,
+            'reservations': reservations,
+            'version': version
         }
 
+    """
+    Parse the sku:stock pairs of stock.load; skus may hold colons
+    but no commas nor whitespace
+
+    @return list of (sku, stock)
+    @raise ValueError on malformed pairs
+    """
+    @staticmethod
+    def parseLoadItems(payload):
+        items = []
+        for item in payload.split(','):
+            if not item:
+                continue
+            (sku, sep, stock) = item.rpartition(':')
+            if not sku:
+                raise ValueError('invalid item `%s\'' % item)
+            # a sku with whitespace couldn't be sent in the text protocol
+            if sku.split() != [sku]:
+                raise ValueError('invalid sku in `%s\'' % item)
+            try:
+                stock = int(stock)
+            except ValueError:
+                raise ValueError('invalid stock in `%s\'' % item)
+            if stock < 0:
+                raise ValueError('negative stock in `%s\'' % item)
+            items.append((sku, stock))
+        return items
+
+    """
+    Add the missing products and set the stock of the others; products
+    are only locked one at a time, so reservations are never held up
+    for long. To leave the CPU to the other commands, the loader sleeps
+    between two slices of products so that it doesn't run more than
+    load_cpu_share of the time.
+
+    @return counts of added, updated and unchanged products
+    """
+    @staticmethod
+    def stockLoad(items):
+        ret = {'added': 0, 'updated': 0, 'unchanged': 0}
+        share = Product.config['load_cpu_share']
+        for start in xrange(0, len(items), Product.LOAD_SLICE):
+            began = time.time()
+            for (sku, stock) in items[start:start + Product.LOAD_SLICE]:
+                Product.locks.acquire(sku)
+                pdata = Product.data.get(sku)
+                if pdata is None:
+                    sku = intern(sku)
+                    Product.data[sku] = Product.newRecord(sku, stock)
+                    Product.changed(('product.add', sku, stock))
+                    ret['added'] += 1
+                elif pdata.stock == stock:
+                    ret['unchanged'] += 1
+                else:
+                    pdata.stock = stock
+                    Product.changed(('stock.set', sku, stock))
+                    ret['updated'] += 1
+                Product.locks.release(sku)
+
+            if share < 1:
+                time.sleep((time.time() - began) * (1 - share) / share)
+        return ret
+
+    """
+    Replace the stock of every product by a vectorized computation
+    over the stock column; the new stock is then published product by
+    product, with the product locked, and only the products whose
+    stock actually changes are published and journaled. A stock.set
+    or stock.dec hitting the same product in between is overwritten.
+
+    @param compute function of a stock block returning the new stock
+    @return number of products whose stock changed
+    """
+    @staticmethod
+    def stockBulk(compute):
+        updated = 0
+        Product.lockAll()
+        try:
+            for (start, stock, reserved, times) in Columns.blocks():
+                new = numpy.maximum(compute(stock), 0)
+                rows = numpy.flatnonzero(new != stock)
+                for i in rows:
+                    sku = Columns.skus[start + i]
+                    value = int(new[i])
+                    Product.lock(sku)
+                    pdata = Product.data[sku]
+                    pdata.publish(value, pdata.state[1])
+                    Product.changed(('stock.set', sku, value))
+                    Product.unlock(sku)
+                updated += len(rows)
+        finally:
+            Product.unlockAll()
+        return updated
+
+    @staticmethod
+    def stockSummary():
+        ret = {
+            'products': 0,
+            'stock': 0,
+            'reserved': 0,
+            'available': 0,
+            'fully_reserved': 0,
+            'out_of_stock': 0
+        }
+        for (start, stock, reserved, times) in Columns.blocks():
+            ret['products'] += len(stock)
+            ret['stock'] += int(stock.sum())
+            ret['reserved'] += int(reserved.sum())
+            ret['available'] += int(numpy.maximum(stock - reserved, 0).sum())
+            ret['fully_reserved'] += int(numpy.count_nonzero((stock > 0) & (reserved >= stock)))
+            ret['out_of_stock'] += int(numpy.count_nonzero(stock <= 0))
+        return ret
+
+    """
+    @return number of products last updated before a timestamp
+    """
+    @staticmethod
+    def stockStale(before):
+        return sum([int(numpy.count_nonzero(times < before)) for (start, stock, reserved, times) in Columns.blocks()])
+
+
+"""
+Index of reservation deadlines
+
+Reservations are kept in a min-heap keyed by their deadline
+(timestamp + ttl) so that the expiration thread only looks at the
+reservations that are actually due. Entries are never removed from
+the middle of the heap: rescheduling a reservation pushes a new entry
+and the old one is recognized as stale (its deadline doesn't match the
+reservation's current deadline) when it's popped or compacted away.
+"""
+
+class DeadlineIndex:
+
+    # heap of (deadline, sku, clid) entries
+    heap = []
+
+    # protects the heap; never acquire a product lock while holding it
+    lock = threading.Lock()
+
+    # number of entries known to be stale: every reschedule or removal
+    # of a scheduled reservation leaves one behind
+    stale = 0
+
+    # entries pushed while the heap is being rebuilt or compacted,
+    # None otherwise
+    pushed = None
+
+    # serializes rebuild() and compact(), which both walk the heap
+    # without the lock and collect the entries pushed meanwhile
+    walking = threading.Lock()
+
+    # don't bother compacting below this number of stale entries
+    COMPACT_MIN = 1024
+
+    # default ttl, set by the expiration thread
+    ttl = 60
+
+    """
+    (Re)schedule a reservation; must be called with the product locked
+    """
+    @staticmethod
+    def schedule(sku, clid, rdata):
+        ttl = rdata.ttl if rdata.ttl else DeadlineIndex.ttl
+        deadline = rdata.timestamp + ttl
+        DeadlineIndex.lock.acquire()
+        if rdata.deadline is not None:
+            DeadlineIndex.stale += 1
+        rdata.deadline = deadline
+        # interned, the entry shares the strings of the product data
+        # instead of holding on to the command's arguments
+        entry = (deadline, intern(sku), intern(clid))
+        heapq.heappush(DeadlineIndex.heap, entry)
+        if DeadlineIndex.pushed is not None:
+            DeadlineIndex.pushed.append(entry)
+        DeadlineIndex.lock.release()
+
+    """
+    Forget the deadline of a reservation that is removed or replaced
+    other than by expiring; its entry is now stale. Must be called
+    with the product locked
+    """
+    @staticmethod
+    def unschedule(rdata):
+        if rdata.deadline is None:
+            return
+        DeadlineIndex.lock.acquire()
+        DeadlineIndex.stale += 1
+        rdata.deadline = None
+        DeadlineIndex.lock.release()
+
+    """
+    Pop all the entries whose deadline is due; the caller has to
+    check them against the reservation they point to
+    """
+    @staticmethod
+    def popDue(now):
+        ret = []
+        DeadlineIndex.lock.acquire()
+        heap = DeadlineIndex.heap
+        while heap and heap[0][0] <= now:
+            ret.append(heapq.heappop(heap))
+        DeadlineIndex.lock.release()
+        return ret
+
+    """
+    Account for popped entries that turned out to be stale
+    """
+    @staticmethod
+    def discarded(count):
+        DeadlineIndex.lock.acquire()
+        DeadlineIndex.stale = max(0, DeadlineIndex.stale - count)
+        DeadlineIndex.lock.release()
+
+    """
+    Drop stale entries once they make up more than half of the heap.
+    The heap is filtered from a copy, without the index locked, so
+    that schedule() isn't held up; the entries scheduled in the
+    meantime go in the new heap as well. Called by the expiration
+    thread, which is the one popping entries.
+    """
+    @staticmethod
+    def compact():
+        if DeadlineIndex.stale < DeadlineIndex.COMPACT_MIN or DeadlineIndex.stale * 2 < len(DeadlineIndex.heap):
+            return
+        DeadlineIndex.walking.acquire()
+        DeadlineIndex.lock.acquire()
+        entries = list(DeadlineIndex.heap)
+        stale = DeadlineIndex.stale
+        DeadlineIndex.pushed = []
+        DeadlineIndex.lock.release()
+
+        heap = []
+        for entry in entries:
+            (deadline, sku, clid) = entry
+            # lockless read; at worst a stale entry survives until it's popped
+            rdata = Product.reservationGetUnlocked(sku, clid) if sku in Product.data else None
+            if rdata and rdata.deadline == deadline:
+                heap.append(entry)
+
+        DeadlineIndex.lock.acquire()
+        heap.extend(DeadlineIndex.pushed)
+        heapq.heapify(heap)
+        DeadlineIndex.heap = heap
+        # what went stale meanwhile; over-counted if the walk already
+        # left the entries out
+        DeadlineIndex.stale -= stale
+        DeadlineIndex.pushed = None
+        DeadlineIndex.lock.release()
+        DeadlineIndex.walking.release()
+
+    """
+    Recompute every deadline; used after loading the database
+    and when the default ttl changes. The products are walked without
+    the index locked (products are locked meanwhile), so the entries
+    scheduled in the meantime are collected and go in the new heap
+    as well; at worst they're stale.
+    """
+    @staticmethod
+    def rebuild():
+        DeadlineIndex.walking.acquire()
+        DeadlineIndex.lock.acquire()
+        DeadlineIndex.pushed = []
+        DeadlineIndex.lock.release()
+
+        heap = []
+        for [sku, pdata] in Product.getProducts():
+            for clid in pdata.reservations or ():
+                rdata = pdata.reservations[clid]
+                ttl = rdata.ttl if rdata.ttl else DeadlineIndex.ttl
+                rdata.deadline = rdata.timestamp + ttl
+                heap.append((rdata.deadline, sku, clid))
+
+        DeadlineIndex.lock.acquire()
+        heap.extend(DeadlineIndex.pushed)
+        heapq.heapify(heap)
+        DeadlineIndex.heap = heap
+        DeadlineIndex.stale = len(DeadlineIndex.pushed)
+        DeadlineIndex.pushed = None
+        DeadlineIndex.lock.release()
+        DeadlineIndex.walking.release()
+
 
 """
 Implements expiration of item reservation entries
@@ -470,25 +1440,40 @@ class Expiration(threading.Thread):
     def loadConfig(self):
         self.config['ttl'] = Config.getint('expiration', 'ttl', Expiration.DEFAULTS['ttl'])
         self.config['cleanup_interval'] = Config.getint('expiration', 'cleanup_interval', Expiration.DEFAULTS['cleanup_interval'])
+        if DeadlineIndex.ttl != self.config['ttl']:
+            DeadlineIndex.ttl = self.config['ttl']
+            # deadlines relying on the default ttl have moved
+            DeadlineIndex.rebuild()
 
     """
-    Cleanup thread
+    Cleanup thread; only the reservations that are due are visited
     """
     def run(self):
         
         while self.running:
             now = time.time()
-            for [sku, _pdata] in Product.getProducts():
-
-                _expired = []
-                for [clid, _rdata] in Product.getReservations(sku):
-                    if now - Product.reservationGetTimeUnlocked(sku, clid) > self.config['ttl']:
-                        Logger.info("reservation for product " + sku + " and client " + str(clid) + " expired")
-                        _expired.append(clid)
-                for clid in _expired:
+            _stale = 0
+            _expired = 0
+            for (deadline, sku, clid) in DeadlineIndex.popDue(now):
+                if not Product.lock(sku):
+                    _stale += 1
+                    continue
+                rdata = Product.reservationGetUnlocked(sku, clid)
+                if rdata and rdata.deadline == deadline:
+                    Logger.info("reservation for product " + sku + " and client " + str(clid) + " expired")
                     Product.totalReservationsDecUnlocked(sku, Product.reservationGetQtyUnlocked(sku, clid))
                     Product.reservationDelUnlocked(sku, clid)
-                del _expired
+                    _expired += 1
+                else:
+                    # the reservation was rescheduled or removed in the meantime
+                    _stale += 1
+                Product.unlock(sku)
+            if _stale:
+                DeadlineIndex.discarded(_stale)
+            DeadlineIndex.compact()
+            Stats.record('expiration.sweep', time.time() - now)
+            if _expired:
+                Stats.count('expiration.expired', _expired)
             self.event.wait(self.config['cleanup_interval'])
 
     def start(self):
@@ -519,11 +1504,367 @@ class Expiration(threading.Thread):
 
 
 
+"""
+Change feed
+
+A ring buffer of the last changes: every change of a product appends
+an entry holding the state the product was left in, under a global
+sequence number. Caches keep the sequence of the last entry they got
+and catch up with changes.since instead of reading every product
+again; once the entries they miss are overwritten they're told to
+resync, i.e. to read everything again. The feed lives in memory: each
+run of each process starts a new one under a random epoch, which
+clients keep along with their sequence, and a sequence of another
+epoch is answered with a resync too.
+"""
+
+class ChangeFeed:
+
+    # default configuration values
+    DEFAULTS = {
+        'size': 65536
+    }
+
+    # ring of (sequence, sku, stock, total reservations) entries,
+    # allocated by init()
+    entries = []
+
+    # sequence of the last entry
+    seq = 0
+
+    # id of this feed, drawn by init(); never 0 so that clients can
+    # start from epoch 0
+    epoch = 0
+
+    # protects the sequence and the entries; may be acquired with a
+    # product locked
+    lock = threading.Lock()
+
+    # most entries a changes.since answer holds
+    BATCH = 10000
+
+    @staticmethod
+    def init():
+        size = Config.getint('changes', 'size', ChangeFeed.DEFAULTS['size'])
+        if size <= 0:
+            Logger.error('the change feed size must be positive, using %d' % ChangeFeed.DEFAULTS['size'])
+            size = ChangeFeed.DEFAULTS['size']
+        ChangeFeed.entries = [None] * size
+        ChangeFeed.epoch = random.SystemRandom().randint(1, (1 << 62) - 1)
+        Command.register(ChangeFeed.sinceCmd, 'changes.since', 2, 'changes.since <epoch> <seq>', opcode = 38, schema = [('epoch', int), ('seq', int)])
+        Event.register('core.stats', ChangeFeed.statsEvent)
+
+    """
+    changes.since command: the changes after a sequence of an epoch,
+    only the latest one of every product. Clients ask again from the
+    returned epoch and sequence, right away if there's more.
+    """
+    @staticmethod
+    def sinceCmd(args):
+        ret = ChangeFeed.since(args[0], args[1])
+        if ret is None:
+            return Command.result(Command.RET_RESYNC, {'epoch': ChangeFeed.epoch, 'seq': ChangeFeed.seq})
+        (changes, seq, more) = ret
+        return Command.result(Command.RET_SUCCESS, {'epoch': ChangeFeed.epoch, 'seq': seq, 'changes': changes, 'more': more})
+
+    @staticmethod
+    def statsEvent(stats):
+        stats['changes'] = {
+            'epoch': ChangeFeed.epoch,
+            'seq': ChangeFeed.seq,
+            'size': len(ChangeFeed.entries)
+        }
+
+    """
+    Append the current state of a product; must be called with the
+    product locked so that the entries of a product are in the order
+    of its changes
+    """
+    @staticmethod
+    def append(sku):
+        entries = ChangeFeed.entries
+        if not entries:
+            return
+        (stock, totalReservations, version) = Product.data[sku].state
+        ChangeFeed.lock.acquire()
+        ChangeFeed.seq += 1
+        seq = ChangeFeed.seq
+        entries[seq % len(entries)] = (seq, sku, stock, totalReservations)
+        ChangeFeed.lock.release()
+
+    """
+    @return (list of [sequence, sku, stock, total reservations], the
+             sequence to ask from next time, whether there are more
+             changes) or None if the changes after seq were
+             overwritten already (or seq is unknown, e.g. it belongs
+             to another epoch)
+    """
+    @staticmethod
+    def since(epoch, seq):
+        entries = ChangeFeed.entries
+        size = len(entries)
+        ChangeFeed.lock.acquire()
+        last = ChangeFeed.seq
+        ChangeFeed.lock.release()
+        if epoch != ChangeFeed.epoch or seq > last or seq < max(last - size, 0):
+            return None
+
+        # no locking, the entries up to the last sequence are written
+        # already, the ones overwritten meanwhile are recognized
+        end = min(last, seq + ChangeFeed.BATCH)
+        latest = {}
+        for s in xrange(seq + 1, end + 1):
+            entry = entries[s % size]
+            if entry[0] != s:
+                return None
+            latest[entry[1]] = entry
+        changes = [list(entry) for entry in sorted(latest.itervalues())]
+        return (changes, end, end < last)
+
+
+"""
+Push subscriptions
+
+A connection watches products with the watch command and is pushed
+their availability whenever it changes, instead of polling stock.get
+or product.info. Changes are coalesced: every tick the notifier sends
+each connection a single notification holding the current state of
+all the watched products that changed since the previous tick, however
+many times they changed. A client not reading its notifications is
+disconnected once its unread responses exceed max_buffer bytes rather
+than buffered for.
+"""
+
+class Watch:
+
+    # sku -> {connection id: connection}
+    watchers = {}
+
+    # connection id -> set of watched skus
+    connections = {}
+
+    # watched skus changed since the last tick
+    pending = set()
+
+    # protects the above; may be acquired with a product locked
+    lock = threading.Lock()
+
+    @staticmethod
+    def init():
+        Command.register(Watch.watchCmd, 'watch', 1, opcode = 50, schema = [('sku', str)], session = True)
+        Command.register(Watch.unwatchCmd, 'unwatch', 1, opcode = 51, schema = [('sku', str)], session = True)
+        Event.register('core.disconnect', Watch.disconnectEvent)
+        Event.register('core.stats', Watch.statsEvent)
+
+    """
+    watch command; answers with the current state of the product,
+    later changes are pushed
+    """
+    @staticmethod
+    def watchCmd(args, conn):
+        sku = args[0]
+        if Shard.enabled() and Shard.owner(sku) != Shard.index:
+            # the owner can't push to a connection it doesn't hold
+            return Command.result(Command.RET_ERR_OWNER, 'product owned by process %d' % Shard.owner(sku))
+        if conn is None or not sku in Product.data:
+            return Command.result(Command.RET_ERR_GENERAL, 'product not found')
+        # subscribed first, a change made in between is pushed as well
+        Watch.watch(conn, intern(sku))
+        return Command.result(Command.RET_SUCCESS, {sku: Watch.notification(Product.data[sku])})
+
+    @staticmethod
+    def unwatchCmd(args, conn):
+        if conn is not None:
+            Watch.unwatch(conn, args[0])
+        return Command.result(Command.RET_SUCCESS)
+
+    @staticmethod
+    def watch(conn, sku):
+        Watch.lock.acquire()
+        Watch.watchers.setdefault(sku, {})[id(conn)] = conn
+        Watch.connections.setdefault(id(conn), set()).add(sku)
+        Watch.lock.release()
+
+    @staticmethod
+    def unwatch(conn, sku):
+        Watch.lock.acquire()
+        skus = Watch.connections.get(id(conn))
+        if skus and sku in skus:
+            skus.discard(sku)
+            if not skus:
+                del Watch.connections[id(conn)]
+            Watch.unwatchUnlocked(conn, sku)
+        Watch.lock.release()
+
+    @staticmethod
+    def unwatchUnlocked(conn, sku):
+        watchers = Watch.watchers[sku]
+        watchers.pop(id(conn), None)
+        if not watchers:
+            del Watch.watchers[sku]
+
+    """
+    Forget everything a connection watches
+    """
+    @staticmethod
+    def forget(conn):
+        Watch.lock.acquire()
+        for sku in Watch.connections.pop(id(conn), ()):
+            Watch.unwatchUnlocked(conn, sku)
+        Watch.lock.release()
+
+    @staticmethod
+    def disconnectEvent(conn):
+        if id(conn) in Watch.connections:
+            Watch.forget(conn)
+
+    @staticmethod
+    def statsEvent(stats):
+        stats['watch'] = {
+            'connections': len(Watch.connections),
+            'products': len(Watch.watchers)
+        }
+
+    """
+    A product was modified; called for every change, hence the
+    lockless check first, most products aren't watched
+    """
+    @staticmethod
+    def changed(sku):
+        if sku in Watch.watchers:
+            Watch.lock.acquire()
+            Watch.pending.add(sku)
+            Watch.lock.release()
+
+    @staticmethod
+    def notification(pdata):
+        (stock, reservations, version) = pdata.state
+        return {
+            'stock': stock,
+            'reservations': reservations,
+            'available': max(stock - reservations, 0),
+            'version': version
+        }
+
+    """
+    Push the changes since the previous tick
+
+    @param limit Bytes of unread responses a client is disconnected at
+    @return (number of notifications pushed, number of clients disconnected)
+    """
+    @staticmethod
+    def tick(limit):
+        Watch.lock.acquire()
+        pending = Watch.pending
+        Watch.pending = set()
+        # connection id -> (connection, list of skus)
+        targets = {}
+        for sku in pending:
+            for (cid, conn) in Watch.watchers.get(sku, {}).iteritems():
+                if not cid in targets:
+                    targets[cid] = (conn, [])
+                targets[cid][1].append(sku)
+        Watch.lock.release()
+
+        # no locking, the state of a product is consistent
+        states = dict([(sku, Watch.notification(Product.data[sku])) for sku in pending])
+        pushed = 0
+        dropped = 0
+        for (conn, skus) in targets.itervalues():
+            res = Command.result(Command.RET_PUSH, dict([(sku, states[sku]) for sku in skus]))
+            if conn['server'].push(conn, res, limit):
+                pushed += 1
+            else:
+                Watch.forget(conn)
+                dropped += 1
+        return (pushed, dropped)
+
+
+"""
+Pushes the coalesced changes to the watching connections every tick
+"""
+
+class Notifier(threading.Thread):
+
+    # default configuration values
+    DEFAULTS = {
+        'interval': 100,
+        'max_buffer': 1048576
+    }
+
+    def __init__(self):
+
+        self.running = False
+
+        # configuration
+        self.config = {}
+        self.loadConfig()
+
+        # event object used for sleeping
+        self.event = threading.Event()
+
+        Event.register('core.reload', self.reloadEvent)
+        Event.register('core.shutdown', self.shutdownEvent)
+
+        super(Notifier, self).__init__()
+
+        self.start()
+
+    def loadConfig(self):
+        self.config['interval'] = Config.getint('watch', 'interval', Notifier.DEFAULTS['interval'])
+        if self.config['interval'] <= 0:
+            Logger.error('the watch interval must be positive, using %d' % Notifier.DEFAULTS['interval'])
+            self.config['interval'] = Notifier.DEFAULTS['interval']
+        self.config['max_buffer'] = Config.getint('watch', 'max_buffer', Notifier.DEFAULTS['max_buffer'])
+
+    def run(self):
+
+        while self.running:
+            if Watch.pending:
+                now = time.time()
+                (pushed, dropped) = Watch.tick(self.config['max_buffer'])
+                Stats.record('watch.tick', time.time() - now)
+                Stats.count('watch.notifications', pushed)
+                if dropped:
+                    Stats.count('watch.dropped', dropped)
+            self.event.wait(self.config['interval'] / 1000.0)
+
+    def start(self):
+        if not self.running:
+            Logger.info('starting the watch notifier')
+            self.running = True
+            super(Notifier, self).start()
+
+    def stop(self):
+        if self.running:
+            Logger.info('stopping the watch notifier')
+            self.running = False
+            self.event.set()
+            # in case of a reload, the event flag has to be clear
+            # so that the next wait would actually wait
+            self.event.clear()
+            self.join()
+
+    def reloadEvent(self, *args):
+        self.stop()
+        # we need this to start the thread again
+        super(Notifier, self).__init__()
+        self.loadConfig()
+        self.start()
+
+    def shutdownEvent(self, *args):
+        self.stop()
+
+
+
 class ItemReservation:
     @staticmethod
     def init():
         Product.init()
+        ChangeFeed.init()
+        Watch.init()
         exp = Expiration()
+        notifier = Notifier()
 
 # register the module
 Module.register('Item Reservation', ItemReservation)
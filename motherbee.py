@@ -11,6 +11,7 @@ import config
 from server import Server
 from logger import Logger
 from module import Module
+from shard import Shard
 
 VERSION = "2.0.0"
 
@@ -41,15 +42,19 @@ if __name__ == "__main__":
     
     config.Config.init()
     Logger.init()
-    Module.init()
 
-    if config.Config.general.debug:       
-        # run the server attached to the console
-        Server().run()
-    else:
-        # run the server in background
+    if not config.Config.general.debug:
+        # run the server in background; this happens before
+        # loading the modules since their threads wouldn't
+        # survive the fork
         pid = os.fork()
-        if pid == 0:
-            Server().run()
-        else:
+        if pid != 0:
             sys.exit(0)
+
+    # fork the shard processes, if any; modules
+    # are loaded by each one of them
+    Shard.init()
+
+    Module.init()
+
+    Server().run()
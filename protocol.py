@@ -0,0 +1,188 @@
+"""
+Wire protocols
+
+Both protocols are served on the same port; the first byte a client
+sends picks the one used for the whole connection. The framing itself
+lives in client/framing.py, shared with the client.
+
+text    newline delimited commands, the arguments separated by
+        whitespace; each response is a JSON object followed by \\r\\n:
+
+            stock.get sku1
+            {"code": 0, "data": 10}
+
+binary  the client starts with the MAGIC byte, then sends frames:
+
+            length      uint32, size of the rest of the frame
+            opcode      uint16, see Command.register; with the
+                        DEADLINE bit set the first argument is the
+                        timeout of the command in milliseconds (just
+                        like the @<milliseconds> prefix of the text
+                        protocol) and opcode 0 sets the timeout of
+                        the connection's next commands
+            argc        uint8
+            argc times:
+                'i'     int64
+                's'     uint16 length followed by the bytes
+
+        and gets back frames with the same length prefix:
+
+            length      uint32
+            code        int16, result code
+            type        'n' (no data), 'i' (int64), 's' (bytes up to
+                        the end of the frame) or 'j' (JSON up to the
+                        end of the frame)
+            data
+
+All the integers are in network byte order.
+
+In both protocols, connections watching products (see the watch
+command) also get notifications, pushed between the responses: the
+same frames or lines with code 1, answering no command.
+"""
+
+import json
+import struct
+
+from client import framing
+from command import Command
+from exception import ProtocolException
+
+class TextProtocol:
+
+    name = 'text'
+
+    """
+    split the buffer into commands
+
+    @return (list of commands, each one a list of arguments,
+             the remaining partial command)
+    """
+    @staticmethod
+    def split(buf):
+        if not Command.SEPARATOR in buf:
+            return ([], buf)
+        lines = buf.split(Command.SEPARATOR)
+        # an empty line is still answered (with an error)
+        return ([l.split() or [''] for l in lines[:-1]], lines[-1])
+
+    @staticmethod
+    def encode(res):
+        return json.dumps({'code': res[0], 'data': res[1]}) + "\r\n"
+
+
+class BinaryProtocol:
+
+    name = 'binary'
+
+    MAGIC = framing.MAGIC
+    DEADLINE = framing.DEADLINE
+    OPCODES = framing.OPCODES
+
+    REQUEST = framing.REQUEST
+    RESPONSE = framing.RESPONSE
+    LENGTH = framing.LENGTH
+    INT = framing.INT
+    STR = framing.STR
+
+    TYPE_NONE = framing.TYPE_NONE
+    TYPE_INT = framing.TYPE_INT
+    TYPE_STR = framing.TYPE_STR
+    TYPE_JSON = framing.TYPE_JSON
+
+    INT_MIN = framing.INT_MIN
+    INT_MAX = framing.INT_MAX
+
+    MAX_FRAME = framing.MAX_FRAME
+
+    """
+    split the buffer into frames and decode them; the opcode is
+    replaced by the command name
+
+    @return (list of commands, each one a list of arguments,
+             the remaining partial frame)
+    """
+    @staticmethod
+    def split(buf):
+        cmds = []
+        pos = 0
+        end = len(buf)
+        while end - pos >= 4:
+            (length, ) = BinaryProtocol.LENGTH.unpack_from(buf, pos)
+            if length > BinaryProtocol.MAX_FRAME or length < 3:
+                raise ProtocolException('invalid frame length %d' % length)
+            if end - pos - 4 < length:
+                break
+            cmds.append(BinaryProtocol.decodeRequest(buf, pos, length))
+            pos += 4 + length
+        return (cmds, buf[pos:])
+
+    @staticmethod
+    def decodeRequest(buf, pos, length):
+        (length, opcode, argc) = BinaryProtocol.REQUEST.unpack_from(buf, pos)
+        end = pos + 4 + length
+        pos += BinaryProtocol.REQUEST.size
+        deadline = opcode & BinaryProtocol.DEADLINE
+        opcode &= ~BinaryProtocol.DEADLINE
+        if deadline and opcode == 0:
+            # timeout alone
+            args = []
+        else:
+            cmd = Command.opcodes.get(opcode)
+            # unknown opcodes end up with the `no such command' error
+            args = [cmd if cmd else '#%d' % opcode]
+        try:
+            for i in xrange(argc):
+                t = ord(buf[pos])
+                pos += 1
+                if t == BinaryProtocol.TYPE_INT:
+                    args.append(BinaryProtocol.INT.unpack_from(buf, pos)[0])
+                    pos += BinaryProtocol.INT.size
+                elif t == BinaryProtocol.TYPE_STR:
+                    (size, ) = BinaryProtocol.STR.unpack_from(buf, pos)
+                    pos += BinaryProtocol.STR.size
+                    args.append(buf[pos:pos + size])
+                    pos += size
+                else:
+                    raise ProtocolException('invalid argument type %d' % t)
+        except (IndexError, struct.error):
+            raise ProtocolException('truncated frame')
+        if pos != end:
+            raise ProtocolException('frame length mismatch')
+        if deadline:
+            # turn the timeout into the text protocol prefix
+            i = 1 if opcode else 0
+            if len(args) <= i or type(args[i]) not in (int, long):
+                raise ProtocolException('missing timeout')
+            args.insert(0, '@%d' % args.pop(i))
+        return args
+
+    @staticmethod
+    def encode(res):
+        (code, data) = res
+        if data is None:
+            payload = chr(BinaryProtocol.TYPE_NONE)
+        elif type(data) in (int, long) and BinaryProtocol.INT_MIN <= data <= BinaryProtocol.INT_MAX:
+            payload = chr(BinaryProtocol.TYPE_INT) + BinaryProtocol.INT.pack(data)
+        elif type(data) is str:
+            payload = chr(BinaryProtocol.TYPE_STR) + data
+        else:
+            payload = chr(BinaryProtocol.TYPE_JSON) + json.dumps(data)
+        return BinaryProtocol.LENGTH.pack(len(payload) + 2) + struct.pack('!h', code) + payload
+
+    """ ------------------ CLIENT SIDE ------------------ """
+
+    # used to forward commands to the other processes
+    request = staticmethod(framing.request)
+    response = staticmethod(framing.response)
+
+
+"""
+pick the protocol of a new connection from the first bytes it sent
+
+@return (protocol, the data left once the negotiation bytes are dropped)
+"""
+def negotiate(buf):
+    if buf[:1] == BinaryProtocol.MAGIC:
+        return (BinaryProtocol, buf[1:])
+    return (TextProtocol, buf)
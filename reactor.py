@@ -0,0 +1,89 @@
+"""
+Network reactor
+
+Each reactor owns an epoll set and a slice of the client connections;
+connections are registered edge-triggered, so whenever a socket
+becomes readable the reactor drains it (see Manager.read) before
+going back to epoll.
+"""
+
+import errno
+import select
+import threading
+
+from logger import Logger
+
+class Reactor(threading.Thread):
+
+    # seconds between two checks of the running flag
+    POLL_TIMEOUT = 1
+
+    # peer closed its side; python 2 doesn't export it
+    EPOLLRDHUP = getattr(select, 'EPOLLRDHUP', 0x2000)
+
+    # client connection events
+    EVENTS = select.EPOLLIN | EPOLLRDHUP | select.EPOLLET
+
+    def __init__(self, server, index):
+        super(Reactor, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.index = index
+        self.epoll = select.epoll()
+        self.running = False
+
+    """
+    take over a new connection
+    """
+    def add(self, conn):
+        conn['reactor'] = self
+        self.epoll.register(conn['sock'].fileno(), Reactor.EVENTS)
+
+    def remove(self, fd):
+        self.epoll.unregister(fd)
+
+    """
+    start or stop waiting for a connection to become writable;
+    called with the connection's lock held while its output buffer
+    goes from empty to pending or back
+    """
+    def watchOutput(self, conn, enabled):
+        events = Reactor.EVENTS
+        if enabled:
+            events |= select.EPOLLOUT
+        self.epoll.modify(conn['sock'].fileno(), events)
+
+    def handle(self, fd, event):
+        if not fd in self.server.connections:
+            return
+        if event & select.EPOLLOUT:
+            self.server.flush(self.server.connections[fd])
+        if event & (select.EPOLLIN | Reactor.EPOLLRDHUP):
+            # incoming data from client
+            if self.server.manager.dispatch(self.server.connections[fd]) != True:
+                # Client closed connection
+                self.server.closeConnection(fd)
+        elif event & (select.EPOLLHUP | select.EPOLLERR):
+            # socket shutdown
+            self.server.closeConnection(fd)
+
+    def run(self):
+        while self.running:
+            try:
+                for fd, event in self.epoll.poll(Reactor.POLL_TIMEOUT):
+                    self.handle(fd, event)
+            except Exception as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                Logger.exception(str(e))
+        self.epoll.close()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            super(Reactor, self).start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.join()
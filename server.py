@@ -3,13 +3,19 @@ import sys
 import errno
 import socket
 import select
+import threading
+import collections
 
 import worker
 from manager import Manager
+from reactor import Reactor
 from logger import Logger
 from command import Command
+from protocol import BinaryProtocol
 from event import Event
 from config import Config
+from shard import Shard
+from stats import Stats
 
 class Server:
 
@@ -20,8 +26,12 @@ class Server:
         'host': '0.0.0.0',
         'port': 2000,
         'backlog': 0,
+        'reactors': 1
     } 
 
+    # SO_REUSEPORT on linux, python 2 doesn't export it
+    SO_REUSEPORT = 15
+
     def __init__(self):
 
         self.config = {}
@@ -32,16 +42,25 @@ class Server:
         self.running = True
         self.connections = {}
 
-        # initialize the epoll object
+        # initialize the epoll object; it only watches the
+        # listening sockets, connections go to the reactors
         self.epoll = select.epoll()
 
         # workers manager
         self.manager = Manager(self)
         self.manager.start()
+
+        # network reactors, picked round robin for new connections
+        self.reactors = [Reactor(self, i) for i in xrange(max(1, self.config['reactors']))]
+        self.nextReactor = 0
      
         Event.register('core.reload', self.reloadEvent)
         
-        Command.register(self.shutdownCmd, 'core.shutdown', 0, 'core.shutdown')
+        Command.register(self.shutdownCmd, 'core.shutdown', 0, 'core.shutdown', fanout = list, opcode = 1, lane = Command.LANE_ADMIN)
+        Command.register(Command.opcodesCmd, 'core.opcodes', 0, 'core.opcodes', opcode = BinaryProtocol.OPCODES, lane = Command.LANE_ADMIN)
+        Command.register(Command.commandsCmd, 'core.commands', 0, 'core.commands', fanout = list, opcode = 5, lane = Command.LANE_ADMIN)
+        Command.register(self.statsCmd, 'core.stats', 0, 'core.stats', fanout = list, opcode = 7, lane = Command.LANE_ADMIN)
+        Command.register(self.statsResetCmd, 'core.stats.reset', 0, 'core.stats.reset', fanout = list, opcode = 8, lane = Command.LANE_ADMIN)
 
     def loadConfig(self):
         self.config['server_name'] = Config.get('general', 'server_name', Server.DEFAULTS['server_name'])
@@ -50,6 +69,7 @@ class Server:
         self.config['backlog'] = Config.getint('general', 'backlog', Server.DEFAULTS['backlog']) 
         if self.config['backlog'] <= 0:
             self.config['backlog'] = socket.SOMAXCONN
+        self.config['reactors'] = Config.getint('general', 'reactors', Server.DEFAULTS['reactors'])
  
 
     def reloadEvent(self, *args):
@@ -59,58 +79,235 @@ class Server:
         self.stop()
         return Command.result(Command.RET_SUCCESS)
 
+    """
+    runtime statistics; latencies are in microseconds
+    """
+    def statsCmd(self, args):
+        ret = Stats.summary()
+        ret['connections'] = len(self.connections)
+        ret['commands'] = Command.stats()
+        ret['workers'] = self.manager.queueStats()
+        # modules add their own
+        Event.dispatch('core.stats', ret)
+        return Command.result(Command.RET_SUCCESS, ret)
+
+    def statsResetCmd(self, args):
+        Stats.reset()
+        Command.resetStats()
+        Event.dispatch('core.stats.reset')
+        return Command.result(Command.RET_SUCCESS)
+
     def stop(self):
         self.running = False
 
     def closeConnection(self, fd):
-        self.epoll.unregister(fd)
-        addr = self.connections[fd]['addr']
-        Logger.info(addr[0] + ":" + str(addr[1]) + " left")
-        self.connections[fd]['sock'].close()
-        del self.connections[fd]
+        conn = self.connections.pop(fd, None)
+        if not conn:
+            return
+        conn['reactor'].remove(fd)
+        self.manager.forget(fd)
+        addr = conn['addr']
+        conn['lock'].acquire()
+        if conn['out']:
+            Logger.info(addr[0] + ":" + str(addr[1]) + " left with %d bytes of responses not sent" % sum([len(o) for o in conn['out']]))
+        else:
+            Logger.info(addr[0] + ":" + str(addr[1]) + " left")
+        conn['closed'] = True
+        conn['out'] = []
+        conn['outBytes'] = 0
+        conn['sock'].close()
+        conn['lock'].release()
+        # modules drop whatever they kept about the connection
+        Event.dispatch('core.disconnect', conn)
+
+    """
+    send data to a client without blocking; whatever the socket
+    doesn't take is kept in the connection's output buffer and
+    sent by the reactor once the socket is writable again
+    """
+    def send(self, conn, data):
+        conn['lock'].acquire()
+        try:
+            if conn['closed']:
+                return
+            if conn['out']:
+                # keep the order, the reactor is going to flush it
+                conn['out'].append(data)
+                conn['outBytes'] += len(data)
+                return
+            sent = self.write(conn, data)
+            if sent < len(data):
+                conn['out'].append(data[sent:])
+                conn['outBytes'] = len(data) - sent
+                conn['reactor'].watchOutput(conn, True)
+        finally:
+            conn['lock'].release()
 
+    """
+    push a notification, i.e. a result answering no command, to a
+    client; a client that didn't read more than `limit' bytes of
+    responses yet is disconnected instead (0 means no limit). The
+    connection is only shut down here, the reactor finds out and
+    closes it.
+
+    @return False if the client is gone or was disconnected
+    """
+    def push(self, conn, res, limit = 0):
+        conn['lock'].acquire()
+        closed = conn['closed']
+        if not closed and limit and conn['outBytes'] > limit:
+            addr = conn['addr']
+            Logger.warn("disconnecting " + addr[0] + ":" + str(addr[1]) + ": %d bytes of responses not read" % conn['outBytes'])
+            try:
+                conn['sock'].shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            closed = True
+        conn['lock'].release()
+        if closed:
+            return False
+        self.send(conn, conn['protocol'].encode(res))
+        return True
+
+    """
+    send as much as possible from the output buffer; called by
+    the reactor when the socket becomes writable
+    """
+    def flush(self, conn):
+        conn['lock'].acquire()
+        try:
+            if conn['closed'] or not conn['out']:
+                return
+            data = ''.join(conn['out'])
+            sent = self.write(conn, data)
+            if sent < len(data):
+                conn['out'] = [data[sent:]]
+                conn['outBytes'] = len(data) - sent
+            else:
+                conn['out'] = []
+                conn['outBytes'] = 0
+                conn['reactor'].watchOutput(conn, False)
+        finally:
+            conn['lock'].release()
+
+    """
+    write to the socket until it would block
+
+    @return number of bytes sent; everything is considered sent
+            when the connection is broken (the reactor is about to
+            find out and close it)
+    """
+    def write(self, conn, data):
+        sent = 0
+        while sent < len(data):
+            try:
+                n = conn['sock'].send(data[sent:] if sent else data)
+                sent += n
+                Stats.count('bytes_out', n)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                addr = conn['addr']
+                Logger.warn("client " + addr[0] + ":" + str(addr[1]) + " left while sending responses: " + str(e))
+                return len(data)
+        return sent
+
+
+    """
+    accept all the pending connections (the listeners are
+    edge-triggered) and spread them over the reactors
+
+    @param forwarded Whether the connections come from another shard
+    """
+    def accept(self, sock, forwarded):
+        while True:
+            try:
+                (clientsock, address) = sock.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                # e.g. EMFILE; whatever is left will be
+                # picked up with the next connection
+                Logger.error('accept failed: %s' % str(e))
+                break
+            clientsock.setblocking(0)
+            if forwarded:
+                # unix sockets have no address
+                address = ('shard', 0)
+            conn = {
+                'sock': clientsock, 
+                'addr': address,
+                'forwarded': forwarded,
+                # picked by the first bytes received
+                'protocol': None,
+                # responses the socket didn't take yet
+                'out': [],
+                # protects the output buffer and the socket
+                'lock': threading.Lock(),
+                'closed': False,
+                # jobs waiting for a worker (see Manager.assign)
+                'pending': collections.deque(),
+                'scheduled': False,
+                # worker last used, by lane
+                'workers': {},
+                'jobsLock': threading.Lock(),
+                # bytes of commands queued and of responses not sent
+                # yet (see Manager.assign)
+                'queued': 0,
+                'outBytes': 0,
+                # milliseconds the commands may wait for a worker,
+                # 0 for ever (see Manager.parse)
+                'timeout': self.manager.config['timeout'],
+                # for the modules pushing notifications (see push)
+                'server': self
+            }
+            self.connections[clientsock.fileno()] = conn
+            Stats.count('connections')
+            self.reactors[self.nextReactor].add(conn)
+            self.nextReactor = (self.nextReactor + 1) % len(self.reactors)
 
     def run(self):
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if Shard.enabled():
+            # all the shards accept connections on the same port
+            sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', Server.SO_REUSEPORT), 1)
         sock.bind((self.config['host'], self.config['port']))
         sock.listen(self.config['backlog'])
         sock.setblocking(0)
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         listener = sock.fileno()
-        self.epoll.register(listener, select.EPOLLIN | select.EPOLLOUT | select.EPOLLHUP)
+        self.epoll.register(listener, select.EPOLLIN | select.EPOLLET)
+
+        # commands forwarded by the other shards
+        ipcsock = None
+        ipclistener = None
+        if Shard.enabled():
+            ipcsock = Shard.listen()
+            ipclistener = ipcsock.fileno()
+            self.epoll.register(ipclistener, select.EPOLLIN | select.EPOLLET)
+
+        for r in self.reactors:
+            r.start()
 
-        Logger.info("%s server started" % self.config['server_name'])
+        Logger.info("%s server started (%d reactors)" % (self.config['server_name'], len(self.reactors)))
 
         while self.running:
             try:
-                events = self.epoll.poll()
+                events = self.epoll.poll(Reactor.POLL_TIMEOUT)
                 for fd, event in events:
 
                     if fd == listener:
-                        # New connection
-                        (clientsock, address) = sock.accept()
-                        clientsock.setblocking(0)
-                        fileno = clientsock.fileno()
-                        self.epoll.register(fileno, select.EPOLLIN)
-                        self.connections[fileno] = {
-                            'sock': clientsock, 
-                            'addr': address
-                        }
-                    elif event & select.EPOLLIN:
-                        # incoming data from client
-                        if self.manager.dispatch(self.connections[fd]) != True:
-                            # Client closed connection
-                            try:
-                                self.closeConnection(fd)
-                            except:
-                                pass
-
-                    elif event & select.EPOLLHUP:
-                        # socket shutdown
-                        self.closeConnection(fd)
+                        # New connections
+                        self.accept(sock, False)
+                    elif fd == ipclistener:
+                        self.accept(ipcsock, True)
 
             except KeyboardInterrupt:
                 Logger.debug('CTRL-C was pressed. Stopping server')
@@ -131,7 +328,12 @@ class Server:
         Event.dispatch('core.shutdown')
 
         Logger.debug("shutting down network sockets")
+        for r in self.reactors:
+            r.stop()
         self.epoll.unregister(listener)
+        if ipcsock:
+            self.epoll.unregister(ipclistener)
+            ipcsock.close()
         self.epoll.close()
         sock.close()
 
@@ -0,0 +1,267 @@
+"""
+SKU sharding across processes
+
+When `processes` is greater than 1 the server forks that many
+processes, each one owning the skus hashing to its index: its own
+product data, expiration thread and database file. All of them accept
+client connections on the same port (SO_REUSEPORT) and listen on a
+unix socket for commands forwarded by their peers, which speak the
+binary protocol so that the arguments go through as they are.
+
+Commands registered with a `key` are forwarded to the process owning
+the sku found at that argument position; commands registered with a
+`fanout` aggregator are run by every process and the aggregator is
+called with the list of their results, in process order (`list`
+simply returns them all).
+"""
+
+import os
+import sys
+import time
+import zlib
+import errno
+import struct
+import signal
+import socket
+import threading
+
+from config import Config
+from logger import Logger
+from command import Command
+from protocol import BinaryProtocol
+
+class Shard:
+
+    # default configuration values
+    DEFAULTS = {
+        'processes': 1,
+        'ipc_path': '/tmp',
+        'forward_timeout': 30000
+    }
+
+    # number of processes
+    count = 1
+
+    # index of the current process
+    index = 0
+
+    # config options
+    config = {}
+
+    # per thread connections to the other processes
+    local = threading.local()
+
+    @staticmethod
+    def loadConfig():
+        Shard.config['processes'] = Config.getint('general', 'processes', Shard.DEFAULTS['processes'])
+        Shard.config['ipc_path'] = Config.get('general', 'ipc_path', Shard.DEFAULTS['ipc_path'])
+        Shard.config['port'] = Config.getint('general', 'port', 2000)
+        Shard.config['forward_timeout'] = Config.getint('general', 'forward_timeout', Shard.DEFAULTS['forward_timeout'])
+
+    """
+    fork the shard processes; returns in each one of them, while
+    the original process waits for them to finish and exits
+    """
+    @staticmethod
+    def init():
+        Shard.loadConfig()
+        Shard.count = max(1, Shard.config['processes'])
+        if Shard.count == 1:
+            return
+
+        Command.router = staticmethod(Shard.route)
+
+        children = {}
+        for i in xrange(Shard.count):
+            pid = os.fork()
+            if pid == 0:
+                Shard.index = i
+                return
+            children[pid] = i
+
+        # forward termination to the shards
+        def terminate(sig, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, sig)
+                except OSError:
+                    pass
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, terminate)
+
+        while children:
+            try:
+                (pid, status) = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            if pid in children:
+                Logger.info('shard %d (pid %d) exited with status %d' % (children[pid], pid, status))
+                del children[pid]
+        sys.exit(0)
+
+    @staticmethod
+    def enabled():
+        return Shard.count > 1
+
+    """
+    index of the process owning a sku
+    """
+    @staticmethod
+    def owner(sku):
+        return (zlib.crc32(sku) & 0xffffffff) % Shard.count
+
+    @staticmethod
+    def socketPath(index):
+        return os.path.join(Shard.config['ipc_path'], 'motherbee.%d.%d.sock' % (Shard.config['port'], index))
+
+    """
+    unix socket the other processes forward commands to
+    """
+    @staticmethod
+    def listen():
+        path = Shard.socketPath(Shard.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(socket.SOMAXCONN)
+        sock.setblocking(0)
+        return sock
+
+    @staticmethod
+    def connection(index):
+        if not hasattr(Shard.local, 'peers'):
+            Shard.local.peers = {}
+        if not index in Shard.local.peers:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            timeout = Shard.config['forward_timeout']
+            sock.settimeout(timeout / 1000.0 if timeout > 0 else None)
+            sock.connect(Shard.socketPath(index))
+            sock.sendall(BinaryProtocol.MAGIC)
+            Shard.local.peers[index] = [sock, '']
+        return Shard.local.peers[index]
+
+    @staticmethod
+    def disconnect(index):
+        peer = Shard.local.peers.pop(index, None)
+        if peer:
+            try:
+                peer[0].close()
+            except socket.error:
+                pass
+
+    """
+    send a command to another process and wait for its response, at
+    most forward_timeout milliseconds; never called by a network
+    thread (see Manager.runInline)
+
+    @param deadline Time after which the command is not to be run
+                    anymore; the time left goes with the command
+    @return (code, data)
+    """
+    @staticmethod
+    def forward(index, args, deadline = None):
+        opcode = Command.commands[args[0]]['opcode']
+        if opcode is None:
+            return Command.result(Command.RET_ERR_GENERAL, '`%s\' has no opcode, it can\'t be forwarded' % args[0])
+        args = args[1:]
+        if deadline is not None:
+            left = int((deadline - time.time()) * 1000)
+            if left <= 0:
+                return Command.result(Command.RET_TIMEOUT)
+            opcode |= BinaryProtocol.DEADLINE
+            args = [left] + args
+        try:
+            frame = BinaryProtocol.request(opcode, args)
+        except struct.error:
+            # strings are limited to 64KB by the framing
+            return Command.result(Command.RET_ERR_ARGS, 'argument too long to be forwarded')
+        # a connection may have been closed by a restarted peer; retry once
+        for attempt in [0, 1]:
+            try:
+                peer = Shard.connection(index)
+                peer[0].sendall(frame)
+                while True:
+                    (res, peer[1]) = BinaryProtocol.response(peer[1])
+                    if res is not None:
+                        return res
+                    data = peer[0].recv(65536)
+                    if not data:
+                        raise socket.error(errno.ECONNRESET, 'connection closed')
+                    peer[1] += data
+            except socket.timeout:
+                # the response may still come, the connection
+                # can't be used for the next commands anymore
+                Shard.disconnect(index)
+                Logger.error('process %d didn\'t answer `%s\' in time' % (index, args[0]))
+                return Command.result(Command.RET_ERR_GENERAL, 'process %d didn\'t answer in time' % index)
+            except socket.error as e:
+                Shard.disconnect(index)
+                if attempt == 1:
+                    raise
+
+    """
+    run a command on all the processes, this one included
+
+    @return list of results, in process order
+    """
+    @staticmethod
+    def fanout(args, handler, deadline = None):
+        ret = []
+        for i in xrange(Shard.count):
+            if i == Shard.index:
+                ret.append(handler(args[1:]))
+            else:
+                ret.append(Shard.forward(i, args, deadline))
+        return ret
+
+    """
+    whether running a parsed command means waiting for another
+    process, i.e. whether route() would forward it or fan it out
+    """
+    @staticmethod
+    def remote(cmdInfo, args):
+        if Shard.count == 1:
+            return False
+        if cmdInfo['key'] is not None:
+            return Shard.owner(args[cmdInfo['key'] + 1]) != Shard.index
+        return bool(cmdInfo['fanout'])
+
+    """
+    Command router: forward keyed commands to the owner of the sku
+    and fan global commands out
+
+    @return the response, or None if the command is to be run locally
+    """
+    @staticmethod
+    def route(cmdInfo, args, deadline = None):
+        if cmdInfo['key'] is not None:
+            owner = Shard.owner(args[cmdInfo['key'] + 1])
+            if owner == Shard.index:
+                return None
+            return Shard.forward(owner, args, deadline)
+
+        if cmdInfo['fanout']:
+            results = Shard.fanout(args, cmdInfo['handler'], deadline)
+            for r in results:
+                if r[0] != Command.RET_SUCCESS:
+                    return r
+            return Command.result(Command.RET_SUCCESS, cmdInfo['fanout']([r[1] for r in results]))
+
+        return None
+
+
+    """ ------------------ FANOUT AGGREGATORS ------------------ """
+
+    """
+    add up the values of dict results
+    """
+    @staticmethod
+    def sum(results):
+        ret = {}
+        for r in results:
+            for k in r:
+                ret[k] = ret.get(k, 0) + r[k]
+        return ret
@@ -0,0 +1,265 @@
+"""
+Chunked binary snapshot format
+
+    header: magic, format version
+    chunks: type, record count, payload length, crc32, payload
+    end:    an END chunk holding the number of chunks before it
+
+A PRODUCTS chunk holds up to CHUNK_PRODUCTS product records laid out as
+
+    sku length (H), sku, stock (q), total reservations (q),
+    reservation count (I) and for each reservation:
+        client id length (H), client id, qty (q), timestamp (d),
+        ttl override (d, 0 for the default ttl)
+
+Chunks are checksummed independently so they can be streamed from the
+file and decoded by a pool of worker processes while the rest of the
+file is being read. The workers hand back compact rows of tuples, which
+cost the loading process much less to unpickle than dicts would. The META chunk holds everything that isn't a
+product (e.g. the journal sequence).
+
+Run this file to verify a snapshot offline:
+
+    python snapshot.py /var/lib/motherbee/motherbee.db
+"""
+
+import sys
+import zlib
+import json
+import struct
+import cPickle
+import threading
+import collections
+import multiprocessing
+
+from exception import SnapshotException
+
+MAGIC = 'MBSNAP'
+VERSION = 1
+
+HEADER = struct.Struct('!6sH')
+CHUNK = struct.Struct('!BIII')
+
+PRODUCT = struct.Struct('!qqI')
+RESERVATION = struct.Struct('!qdd')
+LENGTH = struct.Struct('!H')
+END = struct.Struct('!I')
+
+# chunk types
+META = 0
+PRODUCTS = 1
+END_CHUNK = 255
+
+# number of products per chunk
+CHUNK_PRODUCTS = 4096
+
+"""
+whether the file starts with our magic
+"""
+def isSnapshot(f):
+    pos = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(pos)
+    return magic == MAGIC
+
+
+def writeChunk(f, ctype, count, payload):
+    f.write(CHUNK.pack(ctype, count, len(payload), zlib.crc32(payload) & 0xffffffff))
+    f.write(payload)
+
+def encodeString(s):
+    s = str(s)
+    return LENGTH.pack(len(s)) + s
+
+def encodeProducts(products, skus):
+    buf = []
+    for sku in skus:
+        pdata = products[sku]
+        reservations = pdata['reservations']
+        buf.append(encodeString(sku))
+        buf.append(PRODUCT.pack(pdata['stock'], pdata['totalReservations'], len(reservations)))
+        for clid in reservations:
+            rdata = reservations[clid]
+            buf.append(encodeString(clid))
+            buf.append(RESERVATION.pack(rdata['qty'], rdata['timestamp'], rdata.get('ttl') or 0))
+    return ''.join(buf)
+
+"""
+write the data collected through the db.save event
+"""
+def write(f, data):
+    f.write(HEADER.pack(MAGIC, VERSION))
+
+    meta = dict(data)
+    products = meta.pop('products', {})
+
+    chunks = 1
+    writeChunk(f, META, len(meta), cPickle.dumps(meta, -1))
+
+    skus = []
+    for sku in products:
+        skus.append(sku)
+        if len(skus) == CHUNK_PRODUCTS:
+            writeChunk(f, PRODUCTS, len(skus), encodeProducts(products, skus))
+            chunks += 1
+            skus = []
+    if skus:
+        writeChunk(f, PRODUCTS, len(skus), encodeProducts(products, skus))
+        chunks += 1
+
+    writeChunk(f, END_CHUNK, 0, END.pack(chunks))
+
+
+"""
+iterate over the (type, count, payload) chunks of a snapshot,
+checking their checksums
+"""
+def chunks(f):
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise SnapshotException('truncated header')
+    (magic, version) = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise SnapshotException('not a snapshot')
+    if version > VERSION:
+        raise SnapshotException('unsupported snapshot version %d' % version)
+
+    count = 0
+    while True:
+        header = f.read(CHUNK.size)
+        if len(header) < CHUNK.size:
+            raise SnapshotException('truncated snapshot: END chunk missing after %d chunks' % count)
+        (ctype, records, length, crc) = CHUNK.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            raise SnapshotException('truncated chunk %d' % count)
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise SnapshotException('checksum mismatch in chunk %d' % count)
+        if ctype == END_CHUNK:
+            if END.unpack(payload)[0] != count:
+                raise SnapshotException('expected %d chunks, found %d' % (END.unpack(payload)[0], count))
+            return
+        count += 1
+        yield (ctype, records, payload)
+
+
+def decodeString(payload, pos):
+    (length, ) = LENGTH.unpack_from(payload, pos)
+    pos += LENGTH.size
+    return (payload[pos:pos + length], pos + length)
+
+"""
+decode a PRODUCTS chunk; this runs in the loader's worker processes
+
+@return list of (sku, stock, total reservations, list of (client id,
+        qty, timestamp, ttl override or 0)) rows
+"""
+def decodeProducts(payload):
+    rows = []
+    pos = 0
+    end = len(payload)
+    while pos < end:
+        (sku, pos) = decodeString(payload, pos)
+        (stock, total, count) = PRODUCT.unpack_from(payload, pos)
+        pos += PRODUCT.size
+        reservations = []
+        for i in xrange(count):
+            (clid, pos) = decodeString(payload, pos)
+            reservations.append((clid, ) + RESERVATION.unpack_from(payload, pos))
+            pos += RESERVATION.size
+        rows.append((sku, stock, total, reservations))
+    return rows
+
+
+"""
+fork the processes decoding the chunks for load(); a child forked
+while other threads run inherits the locks they hold, so this has to
+happen before any thread is started
+
+@return the pool, None if the chunks are to be decoded in process
+"""
+def pool(workers):
+    if workers <= 1 or threading.active_count() > 1:
+        return None
+    return multiprocessing.Pool(workers)
+
+
+"""
+stream a snapshot, decoding the product chunks in the pool (see
+pool()) if there's one; at most a couple of chunks per worker are in
+flight so memory stays close to the size of the loaded data
+
+@param callback called with {'rows': decoded rows} for each chunk, in
+                order
+@return the META data
+"""
+def load(f, callback, pool = None, workers = 0):
+
+    meta = {}
+
+    if pool is None:
+        for (ctype, records, payload) in chunks(f):
+            if ctype == META:
+                meta = cPickle.loads(payload)
+            elif ctype == PRODUCTS:
+                callback({'rows': decodeProducts(payload)})
+        return meta
+
+    pending = collections.deque()
+    for (ctype, records, payload) in chunks(f):
+        if ctype == META:
+            meta = cPickle.loads(payload)
+        elif ctype == PRODUCTS:
+            pending.append(pool.apply_async(decodeProducts, (payload, )))
+            if len(pending) >= workers * 2:
+                callback({'rows': pending.popleft().get()})
+    while pending:
+        callback({'rows': pending.popleft().get()})
+
+    return meta
+
+
+"""
+check a snapshot file
+
+@return a dict of statistics about the snapshot
+@raise SnapshotException if the file is damaged
+"""
+def verify(fileName):
+    ret = {'version': None, 'chunks': 0, 'products': 0, 'reservations': 0}
+    f = open(fileName, 'rb')
+    try:
+        if not isSnapshot(f):
+            raise SnapshotException('not a snapshot')
+        ret['version'] = HEADER.unpack(f.read(HEADER.size))[1]
+        f.seek(0)
+        for (ctype, records, payload) in chunks(f):
+            ret['chunks'] += 1
+            if ctype == META:
+                cPickle.loads(payload)
+            elif ctype == PRODUCTS:
+                try:
+                    rows = decodeProducts(payload)
+                except struct.error as e:
+                    raise SnapshotException('malformed chunk %d: %s' % (ret['chunks'] - 1, str(e)))
+                if len(rows) != records:
+                    raise SnapshotException('chunk %d announces %d products, holds %d' % (ret['chunks'] - 1, records, len(rows)))
+                ret['products'] += len(rows)
+                for row in rows:
+                    ret['reservations'] += len(row[3])
+        if f.read(1):
+            raise SnapshotException('trailing data after the END chunk')
+    finally:
+        f.close()
+    return ret
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print 'usage: %s snapshot_file' % sys.argv[0]
+        sys.exit(2)
+    try:
+        print json.dumps(verify(sys.argv[1]))
+    except (SnapshotException, IOError) as e:
+        print >> sys.stderr, '%s: %s' % (sys.argv[1], str(e))
+        sys.exit(1)
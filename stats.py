@@ -0,0 +1,126 @@
+"""
+Runtime statistics
+
+Counters, values and latency histograms meant to stay on in
+production: recording is an increment on a list or a dict, without
+locking, so concurrent updates may now and then lose a count.
+
+Latencies are recorded in seconds and reported in microseconds.
+"""
+
+import math
+
+class Histogram:
+
+    # buckets per power of 2, i.e. about 19% wide
+    SUB = 4
+
+    # up to 2^40 microseconds (12 days)
+    BUCKETS = 40 * SUB
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = seconds * 1000000.0
+        if us < 1:
+            i = 0
+        else:
+            (m, e) = math.frexp(us)
+            # m is in [0.5, 1)
+            i = min(e * Histogram.SUB + int((m - 0.5) * 2 * Histogram.SUB), Histogram.BUCKETS - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    """
+    upper bound of the bucket of a bucket index
+    """
+    @staticmethod
+    def bound(i):
+        (e, s) = divmod(i + 1, Histogram.SUB)
+        return math.ldexp(0.5 + s / (2.0 * Histogram.SUB), e)
+
+    """
+    value under which a fraction of the recorded values are,
+    within the bucket precision
+    """
+    def percentile(self, fraction):
+        buckets = list(self.buckets)
+        target = sum(buckets) * fraction
+        seen = 0
+        for i in xrange(len(buckets)):
+            seen += buckets[i]
+            if seen >= target and seen > 0:
+                return min(Histogram.bound(i), self.max)
+        return 0
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'avg': int(self.total / self.count),
+            'p50': int(self.percentile(0.5)),
+            'p99': int(self.percentile(0.99)),
+            'p999': int(self.percentile(0.999)),
+            'max': int(self.max)
+        }
+
+
+class Stats:
+
+    # name -> number
+    counters = {}
+
+    # name -> last value
+    values = {}
+
+    # name -> Histogram
+    histograms = {}
+
+    @staticmethod
+    def count(name, n = 1):
+        Stats.counters[name] = Stats.counters.get(name, 0) + n
+
+    @staticmethod
+    def set(name, value):
+        Stats.values[name] = value
+
+    @staticmethod
+    def histogram(name):
+        h = Stats.histograms.get(name)
+        if h is None:
+            h = Stats.histograms.setdefault(name, Histogram())
+        return h
+
+    @staticmethod
+    def record(name, seconds):
+        Stats.histogram(name).record(seconds)
+
+    @staticmethod
+    def summary():
+        return {
+            'counters': dict(Stats.counters),
+            'values': dict(Stats.values),
+            'latency': dict([(k, Stats.histograms[k].summary()) for k in Stats.histograms.keys()])
+        }
+
+    """
+    reset the counters and the histograms; values are kept since
+    they describe the last occurrence of something
+    """
+    @staticmethod
+    def reset():
+        for k in Stats.counters.keys():
+            Stats.counters[k] = 0
+        for h in Stats.histograms.values():
+            h.reset()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+"""
+Bulk stock loader
+
+Streams a CSV stock feed to a running server with the stock.load
+command: products missing from the catalog are added, the others get
+their stock updated. Prints the counts of added, updated, unchanged
+and skipped (malformed) rows as JSON:
+
+    python stockload.py --connect localhost:2000 feed.csv
+    zcat feed.csv.gz | python stockload.py --header -
+
+The rows are sent in batches of up to --batch products, --depth
+batches in flight at once. How much CPU the loading takes on the
+server is capped by the load_cpu_share option of the server.
+"""
+
+import sys
+import csv
+import json
+import time
+import argparse
+
+from client import Client, MotherBeeError, ConnectionError
+
+# a batch has to fit in a binary protocol string argument
+MAX_BATCH_BYTES = 65000
+
+
+"""
+read the feed
+
+@return generator of (sku, stock) or None for the rows to skip
+"""
+def rows(f, args):
+    reader = csv.reader(f, delimiter = args.delimiter)
+    if args.header:
+        next(reader, None)
+    for row in reader:
+        try:
+            sku = row[args.sku_column].strip()
+            stock = int(row[args.stock_column])
+        except (IndexError, ValueError):
+            yield None
+            continue
+        # skus can't hold whitespace (see stock.load)
+        if sku.split() != [sku] or ',' in sku or stock < 0 or len(sku) + 22 > MAX_BATCH_BYTES:
+            yield None
+            continue
+        yield (sku, stock)
+
+
+"""
+group the rows in batches
+
+@return generator of (list of (sku, stock), number of skipped rows)
+"""
+def batches(f, args):
+    batch = []
+    size = 0
+    skipped = 0
+    for row in rows(f, args):
+        if row is None:
+            skipped += 1
+            continue
+        length = len(row[0]) + 22
+        if batch and (len(batch) >= args.batch or size + length > MAX_BATCH_BYTES):
+            yield (batch, skipped)
+            batch = []
+            size = 0
+            skipped = 0
+        batch.append(row)
+        size += length
+    if batch or skipped:
+        yield (batch, skipped)
+
+
+def run(f, mb, args):
+    report = {'added': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0, 'rows': 0, 'errors': []}
+    started = time.time()
+
+    pipeline = mb.pipeline()
+    for (batch, skipped) in batches(f, args):
+        report['skipped'] += skipped
+        report['rows'] += len(batch) + skipped
+        if batch:
+            pipeline.stock_load(batch)
+        if len(pipeline) >= args.depth:
+            collect(pipeline, report)
+    collect(pipeline, report)
+
+    report['elapsed'] = time.time() - started
+    report['rate'] = report['rows'] / report['elapsed'] if report['elapsed'] else 0
+    return report
+
+def collect(pipeline, report):
+    for res in pipeline.execute():
+        if isinstance(res, MotherBeeError):
+            report['errors'].append(str(res))
+            continue
+        for k in ('added', 'updated', 'unchanged'):
+            report[k] += res.get(k, 0)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog = 'stockload', description = 'MotherBee bulk stock loader')
+    parser.add_argument('file', help = 'CSV file, - for stdin')
+    parser.add_argument('--connect', default = 'localhost:2000', help = 'host:port of the server (default localhost:2000)')
+    parser.add_argument('--protocol', choices = ['text', 'binary'], default = 'binary')
+    parser.add_argument('--batch', type = int, default = 2000, help = 'products per stock.load command (default 2000)')
+    parser.add_argument('--depth', type = int, default = 4, help = 'stock.load commands in flight (default 4)')
+    parser.add_argument('--header', action = 'store_true', help = 'skip the first row')
+    parser.add_argument('--delimiter', default = ',', help = 'field delimiter (default ,)')
+    parser.add_argument('--sku-column', type = int, default = 0, help = 'index of the sku column (default 0)')
+    parser.add_argument('--stock-column', type = int, default = 1, help = 'index of the stock column (default 1)')
+
+    args = parser.parse_args()
+    if args.batch < 1 or args.depth < 1:
+        parser.error('--batch and --depth must be positive')
+
+    (host, port) = args.connect.rsplit(':', 1)
+    mb = Client(host, int(port), pool_size = 1, protocol = args.protocol)
+
+    f = sys.stdin if args.file == '-' else open(args.file, 'rb')
+    try:
+        report = run(f, mb, args)
+    except ConnectionError as e:
+        print >> sys.stderr, str(e)
+        sys.exit(1)
+    finally:
+        f.close()
+        mb.close()
+
+    print json.dumps(report, indent = 2, sort_keys = True)
+    sys.exit(1 if report['errors'] else 0)
@@ -1,81 +1,216 @@
-import socket
 import threading
-import Queue
-import re
+import collections
+import random
+import time
 import sys
 
 from command import Command
 from logger import Logger
+from stats import Stats
+
+"""
+Workers run connections rather than single jobs: a connection with
+pending jobs (see Manager.assign) sits in exactly one worker queue at
+a time, so its commands are run in order, and it keeps going back to
+the same worker unless another one steals it while idle.
+
+Every worker belongs to a lane (see Command.LANES) and only runs the
+jobs of that lane; a connection whose next job belongs to another
+lane is handed over to a worker of that lane.
+"""
 
 class Worker(threading.Thread):
 
-    def __init__(self, manager):
+    # workers looked at when trying to steal a connection
+    STEAL_TRIES = 4
+
+    # connections waiting in a queue at which one of them is handed
+    # over to an idle worker right away (see offload)
+    OFFLOAD_THRESHOLD = 2
+
+    def __init__(self, manager, lane):
         super(Worker, self).__init__()
-        self.event = threading.Event()
+        self.lane = lane
+        self.cond = threading.Condition(threading.Lock())
         self.running = False
         self.daemon = True
         self.manager = manager
-        self.queue = Queue.Queue()
+        # connections with pending jobs
+        self.queue = collections.deque()
+        # whether we're in the manager's idle workers queue
+        self.idle = False
+
+    """
+    queue a connection with pending jobs
 
-    def addJob(self, job):
-        self.queue.put(job)
-        self.event.set()
+    @return False if the worker was stopped or has too many
+            connections waiting already
+    """
+    def schedule(self, conn):
+        self.cond.acquire()
+        try:
+            if not self.running:
+                return False
+            if self.full():
+                return False
+            self.queue.append(conn)
+            queued = len(self.queue)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if queued >= Worker.OFFLOAD_THRESHOLD:
+            self.offload()
+        return True
 
-    def doJob(self, job):
+    """
+    whether no more connections can be queued
+    """
+    def full(self):
+        if self.lane in (Command.LANE_ADMIN, Command.LANE_SHARD):
+            return False
+        limit = self.manager.config['worker_queue']
+        return limit and len(self.queue) >= limit
 
-        sock = job['sock']
-        addr = job['addr']
-        cmds = job['commands']
-        socket_ok = True
-        for c in cmds:
-            c = c.strip()
+    """
+    hand the connection queued last over to an idle worker, if any;
+    idle workers only steal when they run out of work, so one that is
+    idle already would otherwise never help
+    """
+    def offload(self):
+        w = self.manager.idleWorkerPop(self.lane)
+        if w is None or w is self:
+            return
+        conn = self.steal()
+        if conn and not w.schedule(conn):
+            # stopped by the manager in the meantime, keep it
+            self.cond.acquire()
+            self.queue.append(conn)
+            self.cond.notify()
+            self.cond.release()
+
+    """
+    hand over a queued connection, the one queued last, to an idle worker
+    """
+    def steal(self):
+        self.cond.acquire()
+        try:
+            if self.queue:
+                return self.queue.pop()
+            return None
+        finally:
+            self.cond.release()
+
+    """
+    next connection to serve: ours first, then one stolen from a
+    few random workers
+    """
+    def next(self):
+        self.cond.acquire()
+        try:
+            if self.queue:
+                return self.queue.popleft()
+        finally:
+            self.cond.release()
+
+        workers = self.manager.workers[self.lane]
+        for i in xrange(min(Worker.STEAL_TRIES, len(workers))):
             try:
-                res = Command.processCmd(re.compile("\s").split(c)) + "\r\n"
-            except:
-                Logger.exception()
+                w = workers[random.randrange(len(workers))]
+            except (IndexError, ValueError):
+                break
+            if w is self:
                 continue
+            conn = w.steal()
+            if conn:
+                return conn
+        return None
 
-            try:
-                if socket_ok:
-                    if sock.fileno() in self.manager.server.connections:
-                        # send the response only if we still have 
-                        # someone to talk to
-                        sock.send(res)
-                    else:
-                        socket_ok = False
-                        Logger.info("client " + addr[0] + ":" + str(addr[1]) + " left while trying to send response for command `" + c + "`")
+    """
+    run the jobs of our lane a connection has pending; if more come
+    in the meantime the connection goes back at the end of our queue
+    so that a busy client doesn't starve the others, unless they're
+    for another lane
+    """
+    def serve(self, conn):
+        conn['workers'][self.lane] = self
+        jobs = []
+        conn['jobsLock'].acquire()
+        while conn['pending'] and conn['pending'][0]['lane'] == self.lane:
+            jobs.append(conn['pending'].popleft())
+        conn['jobsLock'].release()
+
+        now = time.time()
+        for job in jobs:
+            Stats.record('queue_wait.' + self.lane, now - job['time'])
+            Worker.runJob(self.manager, job)
+
+        conn['jobsLock'].acquire()
+        lane = None
+        if conn['pending']:
+            lane = conn['pending'][0]['lane']
+            if lane == self.lane:
+                self.cond.acquire()
+                self.queue.append(conn)
+                self.cond.release()
+        else:
+            conn['scheduled'] = False
+        conn['jobsLock'].release()
+
+        if lane and lane != self.lane:
+            self.manager.schedule(conn)
+
+    """
+    run the commands of a job and send back the responses, all
+    at once; this is also used by the manager to run jobs inline
+    """
+    @staticmethod
+    def runJob(manager, job):
 
+        conn = job['conn']
+        encode = conn['protocol'].encode
+        forwarded = conn['forwarded']
+        out = []
+        for parsed in job['commands']:
+            try:
+                out.append(encode(Command.run(parsed, forwarded, conn)))
             except:
-                socket_ok = False
-                Logger.warn("client " + addr[0] + ":" + str(addr[1]) + " left while trying to send response for command `" + c + "`")
-                # we're not going to insist on writing to a broken socket
+                Logger.exception()
+
+        manager.done(job)
+
+        if out:
+            manager.server.send(conn, ''.join(out))
 
     def getQSize(self):
-        return self.queue.qsize()
+        return len(self.queue)
 
+    """
+    remove the queued connections, e.g. to give them to another
+    worker once we were stopped
+    """
     def emptyQueue(self):
-        while not self.queue.empty():
-            self.queue.get_nowait()
-            self.queue.task_done()
+        self.cond.acquire()
+        ret = list(self.queue)
+        self.queue.clear()
+        self.cond.release()
+        return ret
         
     def isIdle(self):
-        return self.queue.empty()
+        return not self.queue
 
     def run(self):
         while self.running:
-            self.event.wait()
-            while not self.queue.empty():
-                self.doJob(self.queue.get())
-                self.queue.task_done()
-            self.queue.join()
-            if self.running:
-                # do not add ourselves to the idle queue
-                # if stop() was called, otherwise we'll 
-                # end up adding ourselves to the queue
-                # right after we were stopped by the
-                # scale_down thread
-                self.manager.idleWorkerPush(self)
-            self.event.clear()
+            conn = self.next()
+            if conn:
+                self.serve(conn)
+                continue
+            self.cond.acquire()
+            if self.running and not self.queue:
+                if not self.idle:
+                    self.idle = True
+                    self.manager.idleWorkerPush(self)
+                self.cond.wait()
+            self.cond.release()
 
     def start(self):
         if not self.running:
@@ -84,7 +219,9 @@ class Worker(threading.Thread):
 
     def stop(self):
         if self.running:
+            self.cond.acquire()
             self.running = False
-            self.event.set()
+            self.cond.notify()
+            self.cond.release()
             self.join()
         return True